@@ -1,11 +1,35 @@
 import os
 import logging
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import httpx
 import json
+import marshal
+import re
 import uuid
+import weakref
+from abc import ABC, abstractmethod
+import importlib.util
+import random
+import codecs
+import hashlib
+import hmac
+import csv
+import gzip
+import html
+import io
+import cProfile
+import pstats
+import contextvars
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+import sqlite3
+import threading
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -13,6 +37,8 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -27,29 +53,1247 @@ from telegram.ext import (
 # ------------------------------
 API_KEY = os.getenv("PP_API_KEY", "ВАШ_API_КЛЮЧ")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "ВАШ_ТОКЕН")
-BASE_API_URL = "https://4rabet.api.alanbase.com/v1"
+BASE_API_URL = os.getenv("BASE_API_URL", "https://4rabet.api.alanbase.com/v1")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
 PORT = int(os.environ.get("PORT", 8000))
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "YOUR_CHAT_ID")  # 🔒 Должен быть числовой ID
+# Несколько партнёрских аккаунтов: JSON-список в TENANTS или файл TENANTS_FILE, например
+# [{"name": "main", "api_key": "...", "base_url": "...", "chat_ids": [123], "concurrency": 4}]
+# Без них работает один аккаунт из PP_API_KEY / BASE_API_URL / TELEGRAM_CHAT_ID
+TENANTS = os.getenv("TENANTS", "")
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
 
-logging.basicConfig(level=logging.DEBUG)
+# Пул соединений к Alanbase (один клиент на всё приложение)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 30))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", 10))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", 10))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0") == "1"  # нужен пакет h2
+
+# Параллельная загрузка: длинные периоды режутся на куски по STATS_SHARD_DAYS дней
+STATS_SHARD_DAYS = max(1, int(os.getenv("STATS_SHARD_DAYS", 7)))
+ALANBASE_CONCURRENCY = max(1, int(os.getenv("ALANBASE_CONCURRENCY", 4)))
+
+# Одинаковые одновременные запросы к Alanbase выполняются один раз;
+# успешный результат переиспользуется ALANBASE_RESULT_TTL секунд
+ALANBASE_RESULT_TTL = float(os.getenv("ALANBASE_RESULT_TTL", 5))
+
+# Потоковый разбор страниц /conversions (строки обрабатываются по мере прихода байтов)
+ALANBASE_STREAM_PARSE = os.getenv("ALANBASE_STREAM_PARSE", "1") == "1"
+
+# Повторы временных сбоев Alanbase (таймауты, 429, 5xx) с экспоненциальной паузой и джиттером
+ALANBASE_RETRIES = int(os.getenv("ALANBASE_RETRIES", 2))
+ALANBASE_RETRY_BASE = float(os.getenv("ALANBASE_RETRY_BASE", 0.5))
+ALANBASE_RETRY_MAX_DELAY = float(os.getenv("ALANBASE_RETRY_MAX_DELAY", 10))
+# Предохранитель: после N сбоев подряд не ходить в Alanbase CIRCUIT_COOLDOWN секунд
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", 30))
+# Если есть прошлые данные периода, а Alanbase не ответил за столько секунд,
+# показываем их (с пометкой) и обновляем экран в фоне
+ALANBASE_SWR_DEADLINE = float(os.getenv("ALANBASE_SWR_DEADLINE", 3))
+# Сколько расчётов статистики для экранов может идти одновременно; сверх этого запрос
+# сразу получает сохранённые данные или просьбу повторить позже (0 — без ограничения)
+STATS_MAX_CONCURRENT = int(os.getenv("STATS_MAX_CONCURRENT", 8))
+
+# Размер страницы /conversions подбирается по ожидаемому объёму в этих пределах
+ALANBASE_MIN_PER_PAGE = int(os.getenv("ALANBASE_MIN_PER_PAGE", 100))
+ALANBASE_MAX_PER_PAGE = int(os.getenv("ALANBASE_MAX_PER_PAGE", 500))
+
+# Дневной кэш агрегатов (пустой путь — кэш выключен)
+STATS_CACHE_PATH = os.getenv("STATS_CACHE_PATH", "stats_cache.sqlite3")
+# Сколько закрытых дней до сегодняшнего всё равно перезапрашивать: подтверждения
+# и выплаты вчерашнего дня ещё меняются, поэтому по умолчанию вчера тоже живое
+STATS_CACHE_SETTLE_DAYS = max(0, int(os.getenv("STATS_CACHE_SETTLE_DAYS", 1)))
+
+# Построчные данные /common и /conversions в памяти (по дням и sub_id) для экранов
+# «По дням» и «Топ кампаний»; хранится не больше SERIES_MAX_DAYS дней на аккаунт (0 — выкл.)
+SERIES_MAX_DAYS = int(os.getenv("SERIES_MAX_DAYS", 92))
+
+# Очередь доставки postback-уведомлений в Telegram
+POSTBACK_QUEUE_SIZE = int(os.getenv("POSTBACK_QUEUE_SIZE", 1000))
+POSTBACK_WORKERS = max(1, int(os.getenv("POSTBACK_WORKERS", 2)))
+POSTBACK_MAX_RETRIES = int(os.getenv("POSTBACK_MAX_RETRIES", 5))
+POSTBACK_DRAIN_TIMEOUT = float(os.getenv("POSTBACK_DRAIN_TIMEOUT", 5))
+# Режим сводки: postback'и за окно POSTBACK_DIGEST_WINDOW секунд (0 — выключен)
+# склеиваются в одно сообщение, если их не меньше POSTBACK_DIGEST_THRESHOLD
+POSTBACK_DIGEST_WINDOW = float(os.getenv("POSTBACK_DIGEST_WINDOW", 0))
+POSTBACK_DIGEST_THRESHOLD = max(2, int(os.getenv("POSTBACK_DIGEST_THRESHOLD", 3)))
+POSTBACK_DIGEST_LINES = int(os.getenv("POSTBACK_DIGEST_LINES", 5))
+# Пакетный приём /postback: не больше стольких конверсий в одном запросе
+POSTBACK_BATCH_MAX = int(os.getenv("POSTBACK_BATCH_MAX", 10000))
+# Минимальный интервал между сообщениями в один чат (лимиты Telegram)
+TELEGRAM_CHAT_MIN_INTERVAL = float(os.getenv("TELEGRAM_CHAT_MIN_INTERVAL", 1.0))
+
+# Локальный журнал конверсий из postback'ов (пустой путь — выключен)
+LEDGER_PATH = os.getenv("LEDGER_PATH", "ledger.sqlite3")
+# Защита от повторных postback'ов сети
+POSTBACK_DEDUP_SIZE = int(os.getenv("POSTBACK_DEDUP_SIZE", 100000))
+POSTBACK_DEDUP_TTL = float(os.getenv("POSTBACK_DEDUP_TTL", 86400))
+POSTBACK_DEDUP_PATH = os.getenv("POSTBACK_DEDUP_PATH", "")  # пусто — только в памяти
+# Параметры с явным идентификатором конверсии (первый найденный + goal + status образуют ключ)
+POSTBACK_ID_FIELDS = [f.strip() for f in os.getenv("POSTBACK_ID_FIELDS", "conversion_id").split(",") if f.strip()]
+# Идентификаторы клика/транзакции: с одного клика бывает несколько конверсий (повторные
+# депозиты, смена статуса), поэтому к ним в ключ добавляются goal, status, revenue и дата
+POSTBACK_CLICK_ID_FIELDS = [f.strip() for f in os.getenv("POSTBACK_CLICK_ID_FIELDS", "transaction_id,click_id").split(",") if f.strip()]
+# Источник регистраций/FTD/RD: api — Alanbase /conversions, local — журнал postback'ов
+STATS_SOURCE = os.getenv("STATS_SOURCE", "api").lower()
+
+# Снимки экранов статистики (для кнопок метрик/обновления)
+STATS_STORE_CAPACITY = max(1, int(os.getenv("STATS_STORE_CAPACITY", 500)))
+STATS_STORE_TTL = float(os.getenv("STATS_STORE_TTL", 86400))
+
+# Где хранить состояние диалога и снимки: memory — в процессе, sqlite — общий файл
+# (нужен при нескольких воркерах uvicorn на одной машине)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.sqlite3")
+
+# Прогрев при старте: запросить стандартные периоды (закрытые дни лягут в кэш)
+STARTUP_PREFETCH = os.getenv("STARTUP_PREFETCH", "1") == "1"
+# Фоновое обновление стандартных периодов раз в PREWARM_INTERVAL секунд (0 — выкл.);
+# снимок старше PREWARM_MAX_AGE секунд не показывается, идёт живой запрос
+PREWARM_INTERVAL = float(os.getenv("PREWARM_INTERVAL", 300))
+PREWARM_MAX_AGE = float(os.getenv("PREWARM_MAX_AGE", 900))
+
+# Закреплённое live-сообщение со статистикой за сегодня в чате уведомлений аккаунта:
+# счётчики растут от postback'ов, правка не чаще раза в DASHBOARD_EDIT_INTERVAL секунд,
+# сверка с /common раз в DASHBOARD_RECONCILE_INTERVAL секунд
+DASHBOARD_ENABLED = os.getenv("DASHBOARD_ENABLED", "0") == "1"
+DASHBOARD_EDIT_INTERVAL = float(os.getenv("DASHBOARD_EDIT_INTERVAL", 10))
+DASHBOARD_RECONCILE_INTERVAL = float(os.getenv("DASHBOARD_RECONCILE_INTERVAL", 600))
+# Дашборд работает только в одном воркере: счётчики живут в памяти процесса и видят лишь
+# дошедшие до него postback'и. При STATE_BACKEND=sqlite или WEB_CONCURRENCY>1 он не
+# запускается, а файловая блокировка не даст вести его второму процессу на машине
+DASHBOARD_LOCK_PATH = os.getenv("DASHBOARD_LOCK_PATH", "dashboard.lock")
+
+# Токен для /admin/profile (заголовок X-Admin-Token); пусто — HTTP-доступ к профилю выключен
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Выгрузка конверсий в CSV: gzip, сколько байт держать в памяти до сброса на диск,
+# и предел размера файла (Bot API принимает документы до 50 МБ)
+EXPORT_GZIP = os.getenv("EXPORT_GZIP", "1") == "1"
+EXPORT_SPOOL_MAX = int(os.getenv("EXPORT_SPOOL_MAX", 4 * 1024 * 1024))
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", 50 * 1024 * 1024))
+
+MSK_TZ = timezone(timedelta(hours=3), "MSK")  # Europe/Moscow без перехода на летнее время
+
+# DEBUG включает дамп сырых ответов API — только для отладки
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-telegram_app = Application.builder().token(TELEGRAM_TOKEN).build()
+# ------------------------------
+# Профилирование по запросу
+# ------------------------------
+class ProfileSession:
+    __slots__ = ("label", "phases")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.phases = {}
+
+_profile_session = contextvars.ContextVar("profile_session", default=None)
+
+@contextmanager
+def profile_phase(name: str):
+    """Добавляет время блока к фазе текущего профилируемого обновления (иначе ничего не делает)"""
+    session = _profile_session.get()
+    if session is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        session.phases[name] = session.phases.get(name, 0.0) + time.perf_counter() - started
+
+def profile_label(label: str):
+    session = _profile_session.get()
+    if session is not None:
+        session.label = label
+
+class Profiler:
+    """Профилирует следующие N обновлений или sample_pct% из них: время по фазам и cProfile.
+
+    cProfile видит весь поток, поэтому параллельные запросы попадают в профиль вместе
+    с профилируемым; фазы считаются точно по contextvars.
+    """
+
+    def __init__(self):
+        self._profile = None
+        self.reset()
+
+    def reset(self):
+        if self._profile is not None and self._active:
+            self._profile.disable()
+        self._remaining = 0
+        self._sample = 0.0
+        self._profile = None
+        self._active = 0
+        self.started_at = None
+        self.updates = 0
+        self.phases = {}    # фаза → [вызовов, сумма, максимум]
+        self.slowest = []   # (секунд, метка, фазы)
+
+    def start(self, updates: int = 0, sample: float = 0.0):
+        self.reset()
+        self._remaining = max(0, updates)
+        self._sample = min(100.0, max(0.0, sample))
+        self._profile = cProfile.Profile()
+        self.started_at = time.time()
+        logger.info(f"Профилирование: следующие {self._remaining} обновлений, выборка {self._sample:g}%")
+
+    @property
+    def armed(self) -> bool:
+        return self._remaining > 0 or self._sample > 0
+
+    def _take(self) -> bool:
+        if self._remaining > 0:
+            self._remaining -= 1
+            return True
+        return self._sample > 0 and random.random() * 100 < self._sample
+
+    @asynccontextmanager
+    async def session(self, label: str):
+        if self._profile is None or not self._take():
+            yield
+            return
+        prof = self._profile
+        session = ProfileSession(label)
+        token = _profile_session.set(session)
+        if self._active == 0:
+            prof.enable()
+        self._active += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            _profile_session.reset(token)
+            if prof is self._profile:
+                self._active -= 1
+                if self._active == 0:
+                    prof.disable()
+                self._record(session, elapsed)
+
+    def _record(self, session: ProfileSession, elapsed: float):
+        self.updates += 1
+        for name, seconds in (("total", elapsed), *session.phases.items()):
+            acc = self.phases.setdefault(name, [0, 0.0, 0.0])
+            acc[0] += 1
+            acc[1] += seconds
+            acc[2] = max(acc[2], seconds)
+        self.slowest.append((elapsed, session.label, dict(session.phases)))
+        self.slowest.sort(key=lambda item: item[0], reverse=True)
+        del self.slowest[5:]
+
+    def _stats(self):
+        # create_stats() выключает профайлер — пока идут профилируемые обновления, не трогаем
+        if self._profile is None or self._active or not self.updates:
+            return None
+        return pstats.Stats(self._profile)
+
+    def summary(self, top: int = 15) -> dict:
+        functions = []
+        stats = self._stats()
+        if stats is not None:
+            stats.sort_stats("cumulative")
+            for func in stats.fcn_list[:top]:
+                cc, nc, tt, ct, _ = stats.stats[func]
+                filename, line, name = func
+                functions.append({
+                    "function": f"{os.path.basename(filename)}:{line}({name})",
+                    "calls": nc, "tottime": round(tt, 6), "cumtime": round(ct, 6)
+                })
+        return {
+            "armed": self.armed,
+            "remaining": self._remaining,
+            "sample_pct": self._sample,
+            "started_at": self.started_at,
+            "updates": self.updates,
+            "phases": {
+                name: {"count": n, "total": round(total, 6), "avg": round(total / n, 6), "max": round(peak, 6)}
+                for name, (n, total, peak) in sorted(self.phases.items(), key=lambda kv: -kv[1][1])
+            },
+            "slowest": [
+                {"seconds": round(sec, 6), "label": label, "phases": {k: round(v, 6) for k, v in phases.items()}}
+                for sec, label, phases in self.slowest
+            ],
+            "functions": functions
+        }
+
+    def dump(self):
+        """Профиль в формате pstats (байты) или None"""
+        stats = self._stats()
+        if stats is None:
+            return None
+        # Тот же формат, что пишет Stats.dump_stats, но без временного файла
+        return marshal.dumps(stats.stats)
+
+profiler = Profiler()
+
+class TimedHTTPXRequest(HTTPXRequest):
+    """Запросы бота к Telegram Bot API идут в фазу telegram профилирования"""
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        with profile_phase("telegram"):
+            return await super().do_request(url, method, request_data, **kwargs)
+
+# ------------------------------
+# Жизненный цикл приложения
+# ------------------------------
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    for tenant in tenants.values():
+        try:
+            get_alanbase_client(tenant)
+        except Exception as e:
+            logger.error(f"Не удалось создать HTTP-клиент Alanbase для {tenant.name} (проверьте api_key): {e}")
+    open_day_cache()
+    open_ledger()
+    await open_postback_dedup()
+    open_state_backend()
+    start_postback_workers()
+    warmup = asyncio.create_task(warm_up())
+    try:
+        yield
+    finally:
+        app_state["ready"] = False
+        warmup.cancel()
+        stop_prewarm_scheduler()
+        await stop_dashboards()
+        await stop_postback_workers()
+        await shutdown_telegram_app()
+        await close_alanbase_clients()
+        close_day_cache()
+        close_ledger()
+        postback_dedup.close()
+        state.close()
+
+app = FastAPI(lifespan=lifespan)
+telegram_app = (
+    Application.builder()
+    .token(TELEGRAM_TOKEN)
+    .base_url(f"{TELEGRAM_API_URL}/bot")
+    .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    .request(TimedHTTPXRequest(connection_pool_size=256))
+    .build()
+)
+
+# ------------------------------
+# Метрики (формат Prometheus)
+# ------------------------------
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+class Counter:
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+class Gauge:
+    """Значение снимается в момент запроса /metrics"""
+
+    def __init__(self, name: str, doc: str, getter):
+        self.name = name
+        self.doc = doc
+        self._getter = getter
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self._getter()}"
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, doc: str, buckets=BUCKETS):
+        self.name = name
+        self.doc = doc
+        self._buckets = buckets
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self._buckets), 0, 0.0]
+        counts = state[0]
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[i] += 1
+        state[1] += 1
+        state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, count, total) in self._values.items():
+            for bound, n in zip(self._buckets, counts):
+                yield f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {n}"
+            yield f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+            yield f"{self.name}_sum{_format_labels(key)} {total}"
+
+WEBHOOK_SECONDS = Histogram("postapi_webhook_seconds", "Время обработки /webhook")
+ALANBASE_SECONDS = Histogram("postapi_alanbase_request_seconds", "Длительность запроса к Alanbase")
+ALANBASE_RESPONSES = Counter("postapi_alanbase_responses_total", "Ответы Alanbase по статусам")
+ALANBASE_PAGES = Counter("postapi_alanbase_pages_total", "Загруженные страницы Alanbase")
+ALANBASE_BYTES = Counter("postapi_alanbase_bytes_total", "Байт получено от Alanbase")
+TELEGRAM_SEND_SECONDS = Histogram("postapi_telegram_send_seconds", "Длительность отправки в Telegram")
+TELEGRAM_SENDS = Counter("postapi_telegram_sends_total", "Отправки в Telegram по результату")
+POSTBACKS = Counter("postapi_postbacks_total", "Принятые postback'и по результату")
+DAY_CACHE = Counter("postapi_day_cache_total", "Обращения к дневному кэшу")
+ALANBASE_RETRIES_TOTAL = Counter("postapi_alanbase_retries_total", "Повторы запросов к Alanbase")
+STATS_REQUESTS = Counter("postapi_stats_requests_total", "Запросы экранов статистики по исходу")
+
+METRICS = [
+    WEBHOOK_SECONDS, ALANBASE_SECONDS, ALANBASE_RESPONSES, ALANBASE_PAGES, ALANBASE_BYTES,
+    TELEGRAM_SEND_SECONDS, TELEGRAM_SENDS, POSTBACKS, DAY_CACHE, ALANBASE_RETRIES_TOTAL, STATS_REQUESTS,
+    Gauge("postapi_stats_inflight", "Расчётов статистики в работе", lambda: len(_stats_inflight)),
+    Gauge(
+        "postapi_alanbase_circuit_open", "Аккаунтов с открытым предохранителем Alanbase",
+        lambda: sum(t.breaker.state != "closed" for t in tenants.values())
+    ),
+    Gauge("postapi_postback_queue_depth", "Сообщений в очереди доставки", lambda: postback_queue.qsize()),
+    Gauge("postapi_postback_dropped", "Отброшено из-за переполнения очереди", lambda: postback_stats["dropped"])
+]
+
+@app.get("/metrics")
+async def metrics_handler():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+# ------------------------------
+# HTTP-клиенты Alanbase (keep-alive, свой пул на аккаунт)
+# ------------------------------
+def _build_alanbase_client(tenant) -> httpx.AsyncClient:
+    http2 = HTTP2_ENABLED
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP2_ENABLED=1, но пакет h2 не установлен — используем HTTP/1.1")
+        http2 = False
+    return httpx.AsyncClient(
+        base_url=tenant.base_url,
+        headers={"API-KEY": tenant.api_key},
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+            write=HTTP_WRITE_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT
+        )
+    )
+
+def get_alanbase_client(tenant) -> httpx.AsyncClient:
+    """Возвращает клиент Alanbase аккаунта (создаёт при первом обращении)"""
+    if tenant.client is None or tenant.client.is_closed:
+        tenant.client = _build_alanbase_client(tenant)
+        logger.info(f"HTTP-клиент Alanbase создан: {tenant.name}")
+    return tenant.client
+
+async def close_alanbase_clients():
+    for tenant in tenants.values():
+        if tenant.client is not None:
+            await tenant.client.aclose()
+            tenant.client = None
+            logger.info(f"HTTP-клиент Alanbase закрыт: {tenant.name}")
+
+# ------------------------------
+# Повторы и предохранитель для Alanbase
+# ------------------------------
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """После threshold сбоев подряд перестаёт пускать запросы на cooldown секунд,
+    затем пропускает одну пробную попытку"""
+
+    def __init__(self, threshold: int, cooldown: float, name: str = "Alanbase"):
+        self._name = name
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probe_at = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self._cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open":
+            return False
+        now = time.monotonic()
+        # Пробный запрос один; если он завис дольше cooldown — пускаем следующий
+        if self._probe_at is not None and now - self._probe_at < self._cooldown:
+            return False
+        self._probe_at = now
+        return True
+
+    def success(self):
+        if self._opened_at is not None:
+            logger.info(f"{self._name} снова отвечает, предохранитель закрыт")
+        self._failures = 0
+        self._opened_at = None
+        self._probe_at = None
+
+    def failure(self):
+        self._failures += 1
+        self._probe_at = None
+        if self._opened_at is not None or self._failures >= self._threshold:
+            if self._opened_at is None:
+                logger.warning(f"{self._name}: {self._failures} сбоев подряд, предохранитель открыт на {self._cooldown:g} с")
+            self._opened_at = time.monotonic()
+
+# ------------------------------
+# Аккаунты (тенанты)
+# ------------------------------
+class Tenant:
+    """Партнёрский аккаунт: ключ, адрес API, разрешённые чаты и свои лимиты"""
+    __slots__ = (
+        "name", "api_key", "base_url", "chat_ids", "notify_chat_id",
+        "client", "semaphore", "breaker", "rows_per_day"
+    )
+
+    def __init__(self, name, api_key, base_url, chat_ids, notify_chat_id=None, concurrency=ALANBASE_CONCURRENCY):
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url
+        self.chat_ids = chat_ids
+        self.notify_chat_id = notify_chat_id if notify_chat_id is not None else (chat_ids[0] if chat_ids else None)
+        self.client = None
+        self.semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN, f"Alanbase {name}")
+        self.rows_per_day = None
+
+def _parse_chat_ids(values) -> list:
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(str(value).strip()))
+        except ValueError:
+            logger.error(f"Некорректный chat_id в настройках: {value!r}")
+    return ids
+
+def load_tenants() -> dict:
+    raw = TENANTS
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, encoding="utf-8") as fh:
+            raw = fh.read()
+    if not raw.strip():
+        tenant = Tenant("default", API_KEY, BASE_API_URL, _parse_chat_ids([TELEGRAM_CHAT_ID]))
+        return {tenant.name: tenant}
+    result = {}
+    for item in json.loads(raw):
+        tenant = Tenant(
+            item["name"],
+            item["api_key"],
+            item.get("base_url", BASE_API_URL),
+            _parse_chat_ids(item.get("chat_ids", [])),
+            item.get("notify_chat_id"),
+            item.get("concurrency", ALANBASE_CONCURRENCY)
+        )
+        result[tenant.name] = tenant
+    return result
+
+tenants = load_tenants()
+default_tenant = next(iter(tenants.values()))
+
+# chat_id → аккаунты этого чата (первый — основной); проверка доступа за O(1)
+chat_tenants = {}
+for _tenant in tenants.values():
+    for _chat_id in _tenant.chat_ids:
+        chat_tenants.setdefault(_chat_id, []).append(_tenant)
+
+ALL_TENANTS = "*"
+
+class AlanbaseStreamError(Exception):
+    """Обрыв посреди потокового ответа, когда строки уже обработаны (повтор задвоит счёт)"""
+
+def _retry_delay(attempt: int, retry_after=None) -> float:
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), ALANBASE_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(ALANBASE_RETRY_MAX_DELAY, ALANBASE_RETRY_BASE * 2 ** attempt))
+
+async def _alanbase_with_retries(tenant, endpoint: str, send):
+    """send() → (status_code, результат, заголовки); временные сбои и 429 повторяются с джиттером"""
+    breaker = tenant.breaker
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError("Alanbase временно недоступен, повторите позже")
+        failure = None
+        status, result, headers = None, None, {}
+        try:
+            status, result, headers = await send()
+        except httpx.TransportError as e:
+            failure = e
+        if failure is None and status not in RETRYABLE_STATUS:
+            breaker.success()
+            return status, result
+        breaker.failure()
+        if attempt >= ALANBASE_RETRIES:
+            if failure is not None:
+                raise failure
+            return status, result
+        delay = _retry_delay(attempt, headers.get("Retry-After"))
+        reason = status or type(failure).__name__
+        ALANBASE_RETRIES_TOTAL.inc(tenant=tenant.name, endpoint=endpoint, reason=reason)
+        logger.warning(f"Alanbase {tenant.name} /{endpoint}: {reason}, повтор {attempt + 1} через {delay:.2f} с")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+async def alanbase_get(tenant, endpoint: str, params) -> httpx.Response:
+    """GET к Alanbase через пул аккаунта с ограничением параллельности, повторами и метриками"""
+    client = get_alanbase_client(tenant)
+
+    async def send():
+        async with tenant.semaphore:
+            with ALANBASE_SECONDS.time(endpoint=endpoint), profile_phase("alanbase"):
+                r = await client.get(f"/partner/statistic/{endpoint}", params=params)
+        ALANBASE_RESPONSES.inc(tenant=tenant.name, endpoint=endpoint, status=r.status_code)
+        ALANBASE_PAGES.inc(endpoint=endpoint)
+        ALANBASE_BYTES.inc(len(r.content), endpoint=endpoint)
+        return r.status_code, r, r.headers
+
+    _, r = await _alanbase_with_retries(tenant, endpoint, send)
+    return r
+
+async def alanbase_stream(tenant, endpoint: str, params, on_row):
+    """Потоковый GET к Alanbase: каждая строка data сразу уходит в on_row.
+
+    Возвращает (status_code, JsonRowStream) или (status_code, текст ошибки)
+    """
+    client = get_alanbase_client(tenant)
+
+    async def send():
+        async with tenant.semaphore:
+            with ALANBASE_SECONDS.time(endpoint=endpoint), profile_phase("alanbase"):
+                async with client.stream("GET", f"/partner/statistic/{endpoint}", params=params) as r:
+                    ALANBASE_RESPONSES.inc(tenant=tenant.name, endpoint=endpoint, status=r.status_code)
+                    if r.status_code != 200:
+                        await r.aread()
+                        ALANBASE_BYTES.inc(len(r.content), endpoint=endpoint)
+                        return r.status_code, r.text, r.headers
+                    parser = JsonRowStream(on_row)
+                    try:
+                        async for chunk in r.aiter_bytes():
+                            ALANBASE_BYTES.inc(len(chunk), endpoint=endpoint)
+                            with profile_phase("json"):
+                                parser.feed(chunk)
+                    except httpx.TransportError as e:
+                        if parser.rows:
+                            raise AlanbaseStreamError(f"обрыв ответа /{endpoint}: {e}") from e
+                        raise
+                    with profile_phase("json"):
+                        parser.feed(b"", final=True)
+        ALANBASE_PAGES.inc(endpoint=endpoint)
+        return r.status_code, parser, r.headers
+
+    return await _alanbase_with_retries(tenant, endpoint, send)
+
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+
+class JsonRowStream:
+    """Инкрементальный разбор ответа вида {"data": [{...}, ...], "meta": {...}}.
+
+    Элементы data по одному передаются в on_row и не накапливаются;
+    остальные ключи верхнего уровня (meta и т.п.) сохраняются в extra.
+    """
+
+    def __init__(self, on_row):
+        self._on_row = on_row
+        self._decoder = json.JSONDecoder()
+        self._scan = self._decoder.scan_once
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._state = "start"
+        self._key = None
+        self.extra = {}
+        self.rows = 0
+
+    def feed(self, chunk: bytes, final: bool = False):
+        self._buf += self._utf8.decode(chunk, final)
+        pos = self._parse(final)
+        self._buf = self._buf[pos:]
+        if final and self._state != "done":
+            raise ValueError("Обрезанный JSON в ответе Alanbase")
+
+    def _decode(self, pos: int, final: bool):
+        """Значение с позиции pos или None, если байтов пока не хватает"""
+        try:
+            value, end = self._decoder.raw_decode(self._buf, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        # Число может быть дочитано не до конца ("1500." из "1500.0"):
+        # считаем его полным, только когда за ним виден разделитель
+        if not final and not isinstance(value, (dict, list, str)):
+            nxt = _JSON_WS.match(self._buf, end).end()
+            if nxt >= len(self._buf) or self._buf[nxt] not in ",]}":
+                return None
+        return value, end
+
+    def _scan_rows(self, pos: int) -> int:
+        """Быстрый цикл по объектам-строкам data; останавливается на первом неполном"""
+        buf = self._buf
+        scan = self._scan
+        on_row = self._on_row
+        match_ws = _JSON_WS.match
+        size = len(buf)
+        rows = 0
+        while pos < size and buf[pos] == "{":
+            try:
+                row, end = scan(buf, pos)
+            except (StopIteration, json.JSONDecodeError):
+                break
+            rows += 1
+            on_row(row)
+            pos = match_ws(buf, end).end()
+            if pos < size and buf[pos] == ",":
+                pos = match_ws(buf, pos + 1).end()
+        self.rows += rows
+        return pos
+
+    def _parse(self, final: bool) -> int:
+        buf = self._buf
+        pos = 0
+        while True:
+            pos = _JSON_WS.match(buf, pos).end()
+            if pos >= len(buf):
+                return pos
+            ch = buf[pos]
+            state = self._state
+            if state == "start":
+                if ch != "{":
+                    raise ValueError("Ожидался JSON-объект")
+                self._state = "key"
+                pos += 1
+            elif state == "key":
+                if ch == "}":
+                    self._state = "done"
+                    return pos + 1
+                if ch == ",":
+                    pos += 1
+                    continue
+                decoded = self._decode(pos, final)
+                if decoded is None:
+                    return pos
+                self._key, pos = decoded
+                self._state = "colon"
+            elif state == "colon":
+                if ch != ":":
+                    raise ValueError("Ожидалось ':'")
+                pos += 1
+                self._state = "array" if self._key == "data" else "value"
+            elif state == "array":
+                if ch != "[":
+                    # data не массив — сохраняем как обычное значение
+                    self._state = "value"
+                    continue
+                pos += 1
+                self._state = "item"
+            elif state == "item":
+                if ch == "]":
+                    pos += 1
+                    self._state = "key"
+                    continue
+                if ch == ",":
+                    pos += 1
+                    continue
+                if ch == "{":
+                    end = self._scan_rows(pos)
+                    if end != pos:
+                        pos = end
+                        continue
+                decoded = self._decode(pos, final)
+                if decoded is None:
+                    return pos
+                row, pos = decoded
+                self.rows += 1
+                self._on_row(row)
+            elif state == "value":
+                decoded = self._decode(pos, final)
+                if decoded is None:
+                    return pos
+                self.extra[self._key], pos = decoded
+                self._state = "key"
+            else:
+                return len(buf)
+
+class SingleFlight:
+    """Склеивает одновременные вызовы с одним ключом в одну задачу.
+
+    Задача отменяется, только когда её перестали ждать все вызывающие.
+    """
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._inflight = {}
+        self._results = {}
+
+    async def do(self, key, factory):
+        loop = asyncio.get_running_loop()
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[0] > loop.time():
+                return cached[1]
+            del self._results[key]
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.create_task(factory())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda t, key=key: self._finish(key, t))
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                # Убираем до отмены: пришедший следом вызов должен начать новую задачу,
+                # а не присоединиться к отменяемой и получить чужой CancelledError
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+                entry[0].cancel()
+
+    def _finish(self, key, task: asyncio.Task):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        # Кэшируем только успешные ответы вида (True, данные)
+        if self._ttl > 0 and result[0]:
+            self._results[key] = (asyncio.get_running_loop().time() + self._ttl, result)
+            if len(self._results) > 1024:
+                now = asyncio.get_running_loop().time()
+                for k in [k for k, (exp, _) in self._results.items() if exp <= now]:
+                    del self._results[k]
+
+alanbase_flight = SingleFlight(ALANBASE_RESULT_TTL)
+
+def split_date_range(date_from: str, date_to: str, shard_days: int = STATS_SHARD_DAYS):
+    """Режет период на куски по shard_days дней, сохраняя время на краях"""
+    start = datetime.strptime(date_from[:10], "%Y-%m-%d").date()
+    end = datetime.strptime(date_to[:10], "%Y-%m-%d").date()
+    shards = []
+    cur = start
+    while cur <= end:
+        last = min(cur + timedelta(days=shard_days - 1), end)
+        s_from = date_from if cur == start else f"{cur} 00:00"
+        s_to = date_to if last == end else f"{last} 23:59"
+        shards.append((s_from, s_to))
+        cur = last + timedelta(days=1)
+    return shards
+
+def _day_runs(days: list, date_from: str, date_to: str):
+    """Склеивает подряд идущие дни в диапазоны, сохраняя время на краях периода"""
+    first = date_from[:10]
+    last = date_to[:10]
+    runs = []
+    for day in days:
+        if runs and runs[-1][1] + timedelta(days=1) == day:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    ranges = []
+    for a, b in runs:
+        r_from = date_from if str(a) == first else f"{a} 00:00"
+        r_to = date_to if str(b) == last else f"{b} 23:59"
+        ranges.extend(split_date_range(r_from, r_to))
+    return ranges
+
+async def _cached_aggregate(tenant, kind: str, date_from: str, date_to: str, fetch_range, zero: dict):
+    """Закрытые дни берёт из day_cache, недостающие докачивает диапазонами, остальное — живым запросом.
+
+    fetch_range возвращает итоги по дням, поэтому непрерывный кусок пропущенных
+    дней стоит столько же запросов, сколько шарды обычного периода.
+    """
+    if day_cache is None:
+        shards = split_date_range(date_from, date_to)
+        results = await asyncio.gather(*(fetch_range(tenant, f, t) for f, t in shards))
+        return _merge_totals(results, zero)
+    cache_kind = f"{tenant.name}:{kind}"
+
+    start = datetime.strptime(date_from[:10], "%Y-%m-%d").date()
+    end = datetime.strptime(date_to[:10], "%Y-%m-%d").date()
+    closed_before = settled_before()
+    full_from = len(date_from) <= 10 or date_from[11:] == "00:00"
+    full_to = len(date_to) <= 10 or date_to[11:] == "23:59"
+
+    closed, live = [], []
+    day = start
+    while day <= end:
+        whole_day = (day != start or full_from) and (day != end or full_to)
+        (closed if whole_day and day < closed_before else live).append(day)
+        day += timedelta(days=1)
+
+    with profile_phase("day_cache"):
+        hits = await asyncio.to_thread(day_cache.get_many, cache_kind, [str(d) for d in closed])
+    missing = [d for d in closed if str(d) not in hits]
+    DAY_CACHE.inc(len(hits), kind=kind, result="hit")
+    DAY_CACHE.inc(len(missing), kind=kind, result="miss")
+    missing_ranges = _day_runs(missing, f"{missing[0]} 00:00", f"{missing[-1]} 23:59") if missing else []
+    live_ranges = _day_runs(live, date_from, date_to)
+
+    results = await asyncio.gather(
+        *(fetch_range(tenant, f, t) for f, t in missing_ranges),
+        *(fetch_range(tenant, f, t) for f, t in live_ranges)
+    )
+    fresh = {}
+    for (r_from, r_to), (ok, by_day) in zip(missing_ranges, results):
+        # Строки без даты не разложить по дням — такой кусок просто не кэшируем
+        if ok and None not in by_day:
+            for d in _days_between(r_from, r_to):
+                fresh[d] = by_day.get(d) or dict(zero)
+    if fresh:
+        with profile_phase("day_cache"):
+            await asyncio.to_thread(day_cache.put_many, cache_kind, fresh)
+    logger.info(
+        f"{tenant.name} /{kind}: из кэша {len(hits)} дн., докачано {len(missing)} дн. "
+        f"({len(missing_ranges)} запр.), живых запросов {len(live_ranges)}"
+    )
+    return _merge_totals([(True, hits), *results], zero)
+
+# ------------------------------
+# Дневной кэш агрегатов (SQLite)
+# ------------------------------
+def today_msk():
+    return datetime.now(MSK_TZ).date()
+
+def settled_before():
+    """Первый день, данные которого ещё могут меняться"""
+    return today_msk() - timedelta(days=STATS_CACHE_SETTLE_DAYS)
+
+def _open_sqlite(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+class DayCache:
+    """Агрегаты по дням (МСК): закрытые дни отдаются из файла без запроса к API"""
+
+    def __init__(self, path: str):
+        self._conn = _open_sqlite(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS day_stats ("
+                "kind TEXT NOT NULL, day TEXT NOT NULL, payload TEXT NOT NULL, "
+                "fetched_at REAL NOT NULL, PRIMARY KEY (kind, day))"
+            )
+
+    def get_many(self, kind: str, days: list) -> dict:
+        if not days:
+            return {}
+        marks = ",".join("?" * len(days))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT day, payload FROM day_stats WHERE kind = ? AND day IN ({marks})",
+                [kind, *days]
+            ).fetchall()
+        return {day: json.loads(payload) for day, payload in rows}
+
+    def put_many(self, kind: str, items: dict):
+        if not items:
+            return
+        now = datetime.now().timestamp()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO day_stats (kind, day, payload, fetched_at) VALUES (?, ?, ?, ?)",
+                [(kind, day, json.dumps(values), now) for day, values in items.items()]
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+day_cache = None
+
+def open_day_cache():
+    global day_cache
+    if STATS_CACHE_PATH and day_cache is None:
+        day_cache = DayCache(STATS_CACHE_PATH)
+        logger.info(f"Дневной кэш статистики: {STATS_CACHE_PATH}")
+
+def close_day_cache():
+    global day_cache
+    if day_cache is not None:
+        day_cache.close()
+        day_cache = None
+
+# ------------------------------
+# Журнал конверсий (postback → SQLite)
+# ------------------------------
+_CONVERSION_DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d")
+
+def parse_conversion_date(value) -> str:
+    """Приводит conversion_date к 'YYYY-MM-DD HH:MM:SS' по МСК (нераспознанное — текущее время)"""
+    text = str(value or "").strip()
+    if text.isdigit():
+        return datetime.fromtimestamp(int(text), MSK_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    for fmt in _CONVERSION_DATE_FORMATS:
+        try:
+            return datetime.strptime(text[:19], fmt).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+    return datetime.now(MSK_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+def _range_bounds(date_from: str, date_to: str):
+    """'YYYY-MM-DD[ HH:MM]' → границы для сравнения с conversion_at"""
+    lo = date_from if len(date_from) > 10 else f"{date_from} 00:00"
+    hi = date_to if len(date_to) > 10 else f"{date_to} 23:59"
+    return f"{lo[:16]}:00", f"{hi[:16]}:59"
+
+class ConversionLedger:
+    """Append-only журнал postback'ов с индексами по дате, цели и офферу"""
+
+    def __init__(self, path: str):
+        self._conn = _open_sqlite(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, received_at REAL NOT NULL, "
+                "conversion_at TEXT NOT NULL, offer_id TEXT, goal TEXT, status TEXT, "
+                "revenue REAL NOT NULL DEFAULT 0, currency TEXT, "
+                "sub_id3 TEXT, sub_id4 TEXT, sub_id5 TEXT, raw TEXT NOT NULL, tenant TEXT)"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conversions)")}
+            if "tenant" not in columns:
+                self._conn.execute("ALTER TABLE conversions ADD COLUMN tenant TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_conv_at ON conversions (conversion_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_conv_goal ON conversions (goal, conversion_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_conv_offer ON conversions (offer_id, conversion_at)")
+
+    @staticmethod
+    def _row(data: dict, received_at: float):
+        return (
+            data.get("tenant", default_tenant.name),
+            received_at,
+            parse_conversion_date(data.get("conversion_date")),
+            data.get("offer_id"),
+            data.get("goal"),
+            data.get("status"),
+            _parse_revenue(data.get("revenue")),
+            data.get("currency", "USD"),
+            data.get("sub_id3"),
+            data.get("sub_id4"),
+            data.get("sub_id5"),
+            json.dumps(data, ensure_ascii=False)
+        )
+
+    def append_many(self, batch: list):
+        now = datetime.now().timestamp()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO conversions (tenant, received_at, conversion_at, offer_id, goal, status, revenue, "
+                "currency, sub_id3, sub_id4, sub_id5, raw) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._row(data, now) for data in batch]
+            )
+
+    def rfr_totals(self, date_from: str, date_to: str, tenant: str) -> dict:
+        lo, hi = _range_bounds(date_from, date_to)
+        out = {"registration": 0, "ftd": 0, "rdeposit": 0, "revenue": 0.0}
+        # Строки до появления колонки tenant относятся к основному аккаунту
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT goal, COUNT(*), COALESCE(SUM(revenue), 0) FROM conversions "
+                "WHERE conversion_at BETWEEN ? AND ? AND COALESCE(tenant, ?) = ? GROUP BY goal",
+                (lo, hi, default_tenant.name, tenant)
+            ).fetchall()
+        for goal, count, revenue in rows:
+            if goal in out:
+                out[goal] += count
+            out["revenue"] += revenue
+        return out
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+ledger = None
+
+def open_ledger():
+    global ledger
+    if LEDGER_PATH and ledger is None:
+        ledger = ConversionLedger(LEDGER_PATH)
+        logger.info(f"Журнал конверсий: {LEDGER_PATH}")
+
+def close_ledger():
+    global ledger
+    if ledger is not None:
+        ledger.close()
+        ledger = None
+
+async def record_postbacks(batch: list):
+    if ledger is None:
+        return
+    try:
+        await asyncio.to_thread(ledger.append_many, batch)
+    except Exception as e:
+        logger.error(f"Не удалось записать postback в журнал: {e}")
+
+async def get_ledger_rfr(tenant, date_from: str, date_to: str):
+    if ledger is None:
+        return False, "Журнал конверсий выключен (LEDGER_PATH)"
+    try:
+        return True, await asyncio.to_thread(ledger.rfr_totals, date_from, date_to, tenant.name)
+    except Exception as e:
+        return False, f"Ошибка журнала конверсий: {e}"
+
+# ------------------------------
+# Идемпотентность postback'ов
+# ------------------------------
+def postback_idempotency_key(data: dict) -> str:
+    # click_id уникален только внутри аккаунта; ключи основного аккаунта не меняются
+    tenant = data.get("tenant", default_tenant.name)
+    prefix = "" if tenant == default_tenant.name else f"{tenant}|"
+    for field in POSTBACK_ID_FIELDS:
+        value = data.get(field)
+        if value:
+            return f"{prefix}{field}:{value}:{data.get('goal', '')}:{data.get('status', '')}"
+    for field in POSTBACK_CLICK_ID_FIELDS:
+        value = data.get(field)
+        if value:
+            parts = (data.get(name, "") for name in ("goal", "status", "revenue", "conversion_date"))
+            return f"{prefix}{field}:{value}:" + ":".join(str(p) for p in parts)
+    raw = json.dumps(sorted((str(k), str(v)) for k, v in data.items()), ensure_ascii=False)
+    return prefix + "sha1:" + hashlib.sha1(raw.encode()).hexdigest()
+
+class DedupIndex:
+    """Ограниченный по размеру и времени индекс уже принятых ключей (опционально в SQLite)"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._seen = OrderedDict()
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def attach(self, path: str):
+        self._conn = _open_sqlite(path)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+            cutoff = time.time() - self._ttl
+            self._conn.execute("DELETE FROM dedup WHERE seen_at < ?", (cutoff,))
+            rows = self._conn.execute(
+                "SELECT key, seen_at FROM dedup ORDER BY seen_at DESC LIMIT ?", (self._max_size,)
+            ).fetchall()
+        for key, seen_at in reversed(rows):
+            self._seen[key] = seen_at
+        logger.info(f"Индекс дедупликации: загружено {len(rows)} ключей из {path}")
+
+    def _evict(self, now: float):
+        cutoff = now - self._ttl
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff and len(self._seen) < self._max_size:
+                break
+            self._seen.popitem(last=False)
+
+    def check_and_add(self, key: str) -> bool:
+        """True — ключ новый и запомнен; False — повтор"""
+        now = time.time()
+        self._evict(now)
+        if key in self._seen:
+            return False
+        self._seen[key] = now
+        return True
+
+    def forget(self, key: str):
+        self._seen.pop(key, None)
+
+    def persist(self, keys: list):
+        if self._conn is None or not keys:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO dedup (key, seen_at) VALUES (?, ?)",
+                [(key, self._seen.get(key, time.time())) for key in keys]
+            )
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+postback_dedup = DedupIndex(POSTBACK_DEDUP_SIZE, POSTBACK_DEDUP_TTL)
+
+async def open_postback_dedup():
+    if POSTBACK_DEDUP_PATH:
+        await asyncio.to_thread(postback_dedup.attach, POSTBACK_DEDUP_PATH)
+
+async def persist_postback_keys(keys: list):
+    try:
+        await asyncio.to_thread(postback_dedup.persist, keys)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить ключи дедупликации: {e}")
 
 # ------------------------------
 # 🔒 СИСТЕМА КОНТРОЛЯ ДОСТУПА
 # ------------------------------
+def tenants_for_chat(chat_id) -> list:
+    """Аккаунты, доступные чату (пустой список — доступа нет)"""
+    return chat_tenants.get(int(chat_id), [])
+
 async def check_access(update: Update) -> bool:
     """Проверяет доступ по chat_id"""
     try:
-        # Приводим оба значения к целым числам
         current_chat_id = int(update.effective_chat.id)
-        allowed_chat_id = int(TELEGRAM_CHAT_ID.strip())
         
-        logger.debug(f"Проверка доступа: {current_chat_id} vs {allowed_chat_id}")
+        logger.debug("Проверка доступа: %s", current_chat_id)
         
-        if current_chat_id != allowed_chat_id:
+        if current_chat_id not in chat_tenants:
             logger.warning(f"🚨 Доступ запрещён для: {current_chat_id}")
             # Удаляем сообщение и уведомляем пользователя
             if update.message:
@@ -81,6 +1325,14 @@ def get_main_menu():
 # ------------------------------
 @app.api_route("/webhook", methods=["GET", "POST"])
 async def webhook_handler(request: Request):
+    started = time.perf_counter()
+    try:
+        async with profiler.session(f"webhook {request.method}"):
+            return await _handle_webhook(request)
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started, method=request.method)
+
+async def _handle_webhook(request: Request):
     if request.method == "GET":
         data = dict(request.query_params)
         return await process_postback_data(data)
@@ -89,12 +1341,16 @@ async def webhook_handler(request: Request):
         data = await request.json()
         if "update_id" in data:
             update = Update.de_json(data, telegram_app.bot)
+            if update.callback_query is not None:
+                profile_label(f"callback {update.callback_query.data}")
+            elif update.message is not None:
+                profile_label(f"message {(update.message.text or '')[:32]}")
             
             # 🔒 Принудительная проверка доступа
             if not await check_access(update):
                 return {"status": "access_denied"}
             
-            if not telegram_app.running:
+            if not telegram_app.running:  # запасной путь, если старт при запуске не удался
                 await init_telegram_app()
             await telegram_app.process_update(update)
         else:
@@ -107,28 +1363,224 @@ async def webhook_handler(request: Request):
 # ------------------------------
 # Инициализация Telegram
 # ------------------------------
+_telegram_init_lock = asyncio.Lock()
+app_state = {"ready": False, "telegram": False, "prefetched": False}
+
 async def init_telegram_app():
-    logger.info("Инициализация Telegram-бота...")
-    await telegram_app.initialize()
-    await telegram_app.start()
-    logger.info("Telegram-бот запущен!")
+    async with _telegram_init_lock:
+        if telegram_app.running:
+            return
+        logger.info("Инициализация Telegram-бота...")
+        await telegram_app.initialize()
+        await telegram_app.start()
+        app_state["telegram"] = True
+        logger.info("Telegram-бот запущен!")
+
+async def shutdown_telegram_app():
+    async with _telegram_init_lock:
+        if telegram_app.running:
+            await telegram_app.stop()
+        await telegram_app.shutdown()
+        app_state["telegram"] = False
+        logger.info("Telegram-бот остановлен")
+
+async def warm_up():
+    """Запуск бота и прогрев статистики; /ready отвечает 200 только после него"""
+    delay = 1
+    while True:
+        try:
+            await init_telegram_app()
+            break
+        except Exception as e:
+            logger.error(f"Не удалось запустить Telegram-бота: {e}, повтор через {delay} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+    if STARTUP_PREFETCH:
+        app_state["prefetched"] = await prewarm_periods()
+    app_state["ready"] = True
+    logger.info("Приложение прогрето и готово")
+    start_prewarm_scheduler()
+    start_dashboards()
+
+@app.get("/ready")
+async def ready_handler():
+    if not app_state["ready"]:
+        return JSONResponse({"status": "starting", **app_state}, status_code=503)
+    return {"status": "ready", **app_state}
 
 # ------------------------------
 # Postback (конверсия)
 # ------------------------------
 async def process_postback_data(data: dict):
-    logger.debug(f"Postback data: {data}")
-    offer_id = data.get("offer_id", "N/A")
-    sub_id3 = data.get("sub_id3", "N/A")
-    goal = data.get("goal", "N/A")
-    revenue = data.get("revenue", "N/A")
-    currency = data.get("currency", "USD")
-    status = data.get("status", "N/A")
-    sub_id4 = data.get("sub_id4", "N/A")
-    sub_id5 = data.get("sub_id5", "N/A")
-    cdate = data.get("conversion_date", "N/A")
-
-    msg = (
+    logger.debug("Postback data: %s", data)
+    
+    name = data.get("tenant", default_tenant.name)
+    tenant = tenants.get(name) if isinstance(name, str) else None
+    if tenant is None:
+        logger.warning(f"Postback для неизвестного аккаунта: {data.get('tenant')}")
+        return JSONResponse({"error": "неизвестный tenant"}, status_code=404)
+    if tenant.notify_chat_id is None:
+        logger.error(f"Для аккаунта {tenant.name} не задан чат уведомлений")
+        return {"error": "Не настроен TELEGRAM_CHAT_ID"}, 500
+    
+    key = postback_idempotency_key(data)
+    if not postback_dedup.check_and_add(key):
+        postback_stats["duplicates"] += 1
+        POSTBACKS.inc(result="duplicate")
+        logger.info(f"Повторный postback пропущен: {key}")
+        return {"status": "duplicate"}
+    
+    if POSTBACK_DIGEST_WINDOW > 0:
+        accepted = postback_digest.add(tenant.notify_chat_id, data)
+    else:
+        accepted = enqueue_message(tenant.notify_chat_id, format_postback_message(data))
+    if not accepted:
+        # Сеть повторит postback — он не должен считаться дублем
+        postback_dedup.forget(key)
+        POSTBACKS.inc(result="rejected")
+        return JSONResponse({"error": "очередь уведомлений переполнена"}, status_code=503)
+    POSTBACKS.inc(result="accepted")
+    dashboard = dashboards.get(tenant.name)
+    if dashboard is not None:
+        dashboard.record(data)
+    await record_postbacks([data])
+    await persist_postback_keys([key])
+    return {"status": "ok"}
+
+# ------------------------------
+# Пакетный приём postback'ов
+# ------------------------------
+if importlib.util.find_spec("orjson") is not None:
+    import orjson
+    _fast_json_loads = orjson.loads
+else:
+    _fast_json_loads = json.loads
+
+def parse_postback_batch(body: bytes, content_type: str = "") -> list:
+    """JSON-объект, JSON-массив или NDJSON → список postback'ов (ValueError при ошибке)"""
+    if "ndjson" not in content_type:
+        try:
+            parsed = _fast_json_loads(body)
+            return parsed if isinstance(parsed, list) else [parsed]
+        except ValueError:
+            if b"\n" not in body.strip():
+                raise
+    return [_fast_json_loads(line) for line in body.splitlines() if line.strip()]
+
+@app.api_route("/postback", methods=["GET", "POST"])
+async def postback_handler(request: Request):
+    started = time.perf_counter()
+    try:
+        if request.method == "GET":
+            return await process_postback_data(dict(request.query_params))
+        try:
+            batch = parse_postback_batch(await request.body(), request.headers.get("content-type", ""))
+        except ValueError as e:
+            return JSONResponse({"error": f"некорректный JSON: {e}"}, status_code=400)
+        if len(batch) > POSTBACK_BATCH_MAX:
+            return JSONResponse({"error": f"больше {POSTBACK_BATCH_MAX} конверсий в запросе"}, status_code=413)
+        return await process_postback_batch(batch)
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started, method=f"postback_{request.method}")
+
+def _normalize_postback(data: dict) -> dict:
+    """Значения из JSON приводятся к строкам, как в query-параметрах GET-postback'а"""
+    out = {}
+    for key, value in data.items():
+        if value is None:
+            value = ""
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)
+        elif not isinstance(value, str):
+            value = str(value)
+        out[str(key)] = value
+    return out
+
+async def process_postback_batch(batch: list):
+    """Принимает пакет целиком: дедупликация, одна постановка в очередь, одна запись в журнал"""
+    admitted, keys, invalid, duplicates = [], [], 0, 0
+    for data in batch:
+        if not isinstance(data, dict):
+            invalid += 1
+            continue
+        # Сначала к строкам: tenant из JSON может оказаться списком или объектом
+        data = _normalize_postback(data)
+        tenant = tenants.get(data.get("tenant", default_tenant.name))
+        if tenant is None or tenant.notify_chat_id is None:
+            invalid += 1
+            continue
+        key = postback_idempotency_key(data)
+        if not postback_dedup.check_and_add(key):
+            duplicates += 1
+            continue
+        admitted.append((tenant, data))
+        keys.append(key)
+    if invalid and not admitted and not duplicates:
+        return JSONResponse({"error": "нет корректных postback'ов", "invalid": invalid}, status_code=400)
+
+    postback_stats["duplicates"] += duplicates
+    POSTBACKS.inc(duplicates, result="duplicate")
+    POSTBACKS.inc(invalid, result="invalid")
+    if admitted and not _enqueue_batch(admitted):
+        for key in keys:
+            postback_dedup.forget(key)
+        POSTBACKS.inc(len(admitted), result="rejected")
+        return JSONResponse({"error": "очередь уведомлений переполнена"}, status_code=503)
+
+    POSTBACKS.inc(len(admitted), result="accepted")
+    for tenant, data in admitted:
+        dashboard = dashboards.get(tenant.name)
+        if dashboard is not None:
+            dashboard.record(data)
+    if admitted:
+        await record_postbacks([data for _, data in admitted])
+        await persist_postback_keys(keys)
+    logger.info(f"Пакет postback'ов: принято {len(admitted)}, дублей {duplicates}, некорректных {invalid}")
+    return {"status": "ok", "accepted": len(admitted), "duplicates": duplicates, "invalid": invalid}
+
+def _enqueue_batch(admitted: list) -> bool:
+    """Все уведомления пакета или ничего: крупные пачки одного чата уходят одной сводкой"""
+    by_chat = {}
+    for tenant, data in admitted:
+        by_chat.setdefault(tenant.notify_chat_id, []).append(data)
+    if POSTBACK_DIGEST_WINDOW > 0:
+        if postback_digest.room < len(admitted):
+            postback_stats["dropped"] += len(admitted)
+            return False
+        for chat_id, items in by_chat.items():
+            for data in items:
+                postback_digest.add(chat_id, data)
+        return True
+    messages = []
+    for chat_id, items in by_chat.items():
+        if len(items) >= POSTBACK_DIGEST_THRESHOLD:
+            messages.append((chat_id, format_postback_digest(items, 0)))
+        else:
+            messages.extend((chat_id, format_postback_message(data)) for data in items)
+    if postback_queue.maxsize - postback_queue.qsize() < len(messages):
+        postback_stats["dropped"] += len(messages)
+        logger.warning(f"Очередь уведомлений переполнена, пакет из {len(admitted)} postback'ов отклонён")
+        return False
+    for chat_id, text in messages:
+        enqueue_message(chat_id, text)
+    return True
+
+def format_postback_message(data: dict) -> str:
+    # Значения приходят от сети как есть: один '<' или '&' ломает HTML-разметку сообщения
+    def field(name, default="N/A"):
+        return html.escape(str(data.get(name, default)))
+
+    offer_id = field("offer_id")
+    sub_id3 = field("sub_id3")
+    goal = field("goal")
+    revenue = field("revenue")
+    currency = field("currency", "USD")
+    status = field("status")
+    sub_id4 = field("sub_id4")
+    sub_id5 = field("sub_id5")
+    cdate = field("conversion_date")
+
+    return (
         "🔔 <b>Новая конверсия!</b>\n\n"
         f"<b>📌 Оффер:</b> <i>{offer_id}</i>\n"
         f"<b>🛠 Подход:</b> <i>{sub_id3}</i>\n"
@@ -139,136 +1591,790 @@ async def process_postback_data(data: dict):
         f"<b>🎯 Адсет:</b> <i>{sub_id5}</i>\n"
         f"<b>⏰ Время конверсии:</b> <i>{cdate}</i>"
     )
-    
-    if not TELEGRAM_CHAT_ID:
-        logger.error("TELEGRAM_CHAT_ID не задан в переменных окружения")
-        return {"error": "Не настроен TELEGRAM_CHAT_ID"}, 500
-    
+
+# ------------------------------
+# Сводка конверсий (склейка всплесков)
+# ------------------------------
+def _parse_revenue(value) -> float:
     try:
-        await telegram_app.bot.send_message(
-            chat_id=TELEGRAM_CHAT_ID,
-            text=msg,
-            parse_mode="HTML"
-        )
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _format_money(by_currency: dict) -> str:
+    return ", ".join(f"{amount:.2f} {html.escape(str(cur))}" for cur, amount in by_currency.items()) or "0.00"
+
+def format_postback_digest(batch: list, window: float) -> str:
+    groups = {"offer_id": {}, "goal": {}, "sub_id4": {}}
+    total = {}
+    for data in batch:
+        cur = data.get("currency", "USD")
+        rev = _parse_revenue(data.get("revenue"))
+        total[cur] = total.get(cur, 0.0) + rev
+        for field, acc in groups.items():
+            bucket = acc.setdefault(data.get(field, "N/A"), {"count": 0, "revenue": {}})
+            bucket["count"] += 1
+            bucket["revenue"][cur] = bucket["revenue"].get(cur, 0.0) + rev
+
+    titles = {"offer_id": "📌 По офферам", "goal": "📊 По типам", "sub_id4": "🎯 По кампаниям"}
+    lines = [
+        f"🔔 <b>Новые конверсии: {len(batch)}</b> {f'за {window:g} с' if window else 'одним пакетом'}\n",
+        f"<b>💰 Выплата:</b> <i>{_format_money(total)}</i>\n"
+    ]
+    for field, acc in groups.items():
+        lines.append(f"<b>{titles[field]}:</b>")
+        top = sorted(acc.items(), key=lambda kv: kv[1]["count"], reverse=True)
+        for key, bucket in top[:10]:
+            lines.append(f"• <i>{html.escape(str(key))}</i>: {bucket['count']} шт., {_format_money(bucket['revenue'])}")
+        if len(top) > 10:
+            lines.append(f"• … ещё {len(top) - 10}")
+        lines.append("")
+
+    if POSTBACK_DIGEST_LINES > 0:
+        lines.append("<b>Первые конверсии:</b>")
+        for data in batch[:POSTBACK_DIGEST_LINES]:
+            parts = (
+                data.get("goal", "N/A"), f"{data.get('revenue', 'N/A')} {data.get('currency', 'USD')}",
+                data.get("sub_id4", "N/A"), data.get("conversion_date", "N/A")
+            )
+            lines.append("• " + " · ".join(html.escape(str(p)) for p in parts))
+    return "\n".join(lines).strip()
+
+class PostbackDigest:
+    """Копит postback'и в течение окна и отправляет сводку (или одиночные сообщения при малом потоке)"""
+
+    def __init__(self, window: float, threshold: int, max_pending: int):
+        self._window = window
+        self._threshold = threshold
+        self._max_pending = max_pending
+        self._buffer = {}
+        self._pending = 0
+        self._timer = None
+
+    @property
+    def room(self) -> int:
+        return self._max_pending - self._pending
+
+    def add(self, chat_id, data: dict) -> bool:
+        if self._pending >= self._max_pending:
+            postback_stats["dropped"] += 1
+            logger.warning("Буфер сводки переполнен, postback отброшен")
+            return False
+        self._buffer.setdefault(chat_id, []).append(data)
+        self._pending += 1
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return True
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._window)
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        buffer, self._buffer = self._buffer, {}
+        self._pending = 0
+        for chat_id, batch in buffer.items():
+            if len(batch) < self._threshold:
+                for data in batch:
+                    enqueue_message(chat_id, format_postback_message(data))
+                continue
+            logger.info(f"Сводка для {chat_id}: {len(batch)} postback'ов в одном сообщении")
+            enqueue_message(chat_id, format_postback_digest(batch, self._window))
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.flush()
+
+postback_digest = PostbackDigest(POSTBACK_DIGEST_WINDOW, POSTBACK_DIGEST_THRESHOLD, POSTBACK_QUEUE_SIZE)
+
+# ------------------------------
+# Очередь доставки уведомлений
+# ------------------------------
+class ChatRateLimiter:
+    """Выдерживает паузу между отправками в один чат (с учётом RetryAfter)"""
+
+    def __init__(self, min_interval: float):
+        self._min_interval = min_interval
+        self._next_at = {}
+        self._locks = {}
+
+    async def wait(self, chat_id):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_at.get(chat_id, 0) - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+                now += delay
+            self._next_at[chat_id] = now + self._min_interval
+
+    def defer(self, chat_id, seconds: float):
+        resume_at = asyncio.get_running_loop().time() + seconds
+        self._next_at[chat_id] = max(self._next_at.get(chat_id, 0), resume_at)
+
+postback_queue = asyncio.Queue(maxsize=POSTBACK_QUEUE_SIZE)
+chat_limiter = ChatRateLimiter(TELEGRAM_CHAT_MIN_INTERVAL)
+postback_stats = {"enqueued": 0, "sent": 0, "retried": 0, "dropped": 0, "failed": 0, "duplicates": 0}
+_postback_workers = []
+
+def enqueue_message(chat_id, text: str, attempt: int = 0) -> bool:
+    try:
+        postback_queue.put_nowait((chat_id, text, attempt))
+    except asyncio.QueueFull:
+        postback_stats["dropped"] += 1
+        logger.warning(f"Очередь уведомлений переполнена ({postback_queue.qsize()}), сообщение отброшено")
+        return False
+    if attempt == 0:
+        postback_stats["enqueued"] += 1
+    return True
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+async def _deliver_message(chat_id, text: str, attempt: int):
+    await chat_limiter.wait(chat_id)
+    started = time.perf_counter()
+    try:
+        await telegram_app.bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+        postback_stats["sent"] += 1
+        TELEGRAM_SENDS.inc(result="ok")
         logger.debug("Postback-сообщение отправлено.")
+        return
+    except RetryAfter as e:
+        delay = _retry_after_seconds(e)
+        TELEGRAM_SENDS.inc(result="retry_after")
+        logger.warning(f"Flood control Telegram: пауза {delay} с для чата {chat_id}")
+    except BadRequest as e:
+        postback_stats["failed"] += 1
+        TELEGRAM_SENDS.inc(result="failed")
+        logger.error(f"Ошибка при отправке postback (без повтора): {e}")
+        return
+    except NetworkError as e:
+        delay = min(2 ** attempt, 60)
+        TELEGRAM_SENDS.inc(result="network_error")
+        logger.warning(f"Сетевая ошибка при отправке postback: {e}, повтор через {delay} с")
     except Exception as e:
+        postback_stats["failed"] += 1
+        TELEGRAM_SENDS.inc(result="failed")
         logger.error(f"Ошибка при отправке postback: {e}")
-        return {"error": "не удалось отправить сообщение"}, 500
-    return {"status": "ok"}
+        return
+    finally:
+        TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started)
+
+    if attempt >= POSTBACK_MAX_RETRIES:
+        postback_stats["failed"] += 1
+        logger.error(f"Postback не доставлен после {attempt + 1} попыток")
+        return
+    chat_limiter.defer(chat_id, delay)
+    postback_stats["retried"] += 1
+    enqueue_message(chat_id, text, attempt + 1)
+
+async def _postback_worker():
+    while True:
+        chat_id, text, attempt = await postback_queue.get()
+        try:
+            await _deliver_message(chat_id, text, attempt)
+        finally:
+            postback_queue.task_done()
+
+def start_postback_workers():
+    if _postback_workers:
+        return
+    for _ in range(POSTBACK_WORKERS):
+        _postback_workers.append(asyncio.create_task(_postback_worker()))
+    logger.info(f"Запущено воркеров доставки: {POSTBACK_WORKERS}")
+
+async def stop_postback_workers():
+    postback_digest.close()
+    if postback_queue.qsize():
+        try:
+            await asyncio.wait_for(postback_queue.join(), POSTBACK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не доставлено при остановке: {postback_queue.qsize()}")
+    for task in _postback_workers:
+        task.cancel()
+    await asyncio.gather(*_postback_workers, return_exceptions=True)
+    _postback_workers.clear()
+
+@app.get("/postback/stats")
+async def postback_stats_handler():
+    return {**postback_stats, "queue_depth": postback_queue.qsize(), "queue_size": POSTBACK_QUEUE_SIZE}
+
+# ------------------------------
+# /start
+# ------------------------------
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 🔒 Проверка доступа
+    if not await check_access(update):
+        return
+
+    txt = "Привет! Выберите команду:"
+    mk = get_main_menu()
+    await update.message.reply_text(txt, parse_mode="HTML", reply_markup=mk)
+
+# ------------------------------
+# Профилирование: /profile и /admin/profile
+# ------------------------------
+def format_profile_summary(summary: dict) -> str:
+    if summary["armed"]:
+        mode = f"осталось {summary['remaining']}, выборка {summary['sample_pct']:g}%"
+    else:
+        mode = "выключено"
+    lines = [f"🩺 <b>Профилирование</b>: {mode}", f"Обработано обновлений: {summary['updates']}", ""]
+    if summary["phases"]:
+        lines.append("<b>Фазы</b> (вызовов · сумма · среднее · максимум, с):")
+        for name, ph in summary["phases"].items():
+            lines.append(f"• {name}: {ph['count']} · {ph['total']:.3f} · {ph['avg']:.3f} · {ph['max']:.3f}")
+        lines.append("<i>json при потоковом разборе входит в alanbase</i>")
+        lines.append("")
+    if summary["slowest"]:
+        lines.append("<b>Самые долгие:</b>")
+        for item in summary["slowest"]:
+            phases = ", ".join(f"{k} {v:.3f}" for k, v in item["phases"].items())
+            lines.append(f"• {item['seconds']:.3f} с — {html.escape(item['label'])}" + (f" ({phases})" if phases else ""))
+        lines.append("")
+    if summary["functions"]:
+        lines.append("<b>cProfile, по cumtime:</b>")
+        rows = [f"{f['cumtime']:>8.3f} {f['calls']:>7} {f['function']}" for f in summary["functions"]]
+        lines.append("<pre>" + html.escape("\n".join(rows), quote=False) + "</pre>")
+    return "\n".join(lines).strip()
+
+def _parse_profile_args(args: list):
+    """['20'] → (20, 0); ['5%'] → (0, 5.0); ValueError при ошибке"""
+    updates, sample = 0, 0.0
+    for arg in args:
+        if arg.endswith("%"):
+            sample = float(arg[:-1])
+        else:
+            updates = int(arg)
+    return updates, sample
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile N | /profile P% | /profile off | /profile file | /profile — сводка"""
+    if not await check_access(update):
+        return
+    args = context.args or []
+    if args == ["off"]:
+        profiler.start(0, 0)
+        await update.message.reply_text("🩺 Профилирование выключено, данные сброшены")
+    elif args == ["file"]:
+        data = profiler.dump()
+        if data is None:
+            await update.message.reply_text("Профиля пока нет (или идёт профилирование)")
+            return
+        await update.message.reply_document(
+            document=io.BytesIO(data), filename="postapi.pstats",
+            caption="python -m pstats postapi.pstats"
+        )
+    elif args:
+        try:
+            updates, sample = _parse_profile_args(args)
+        except ValueError:
+            await update.message.reply_text("Формат: /profile 20 | /profile 5% | /profile off | /profile file")
+            return
+        profiler.start(updates, sample)
+        await update.message.reply_text(f"🩺 Профилирование: следующие {updates} обновлений, выборка {sample:g}%")
+    else:
+        await update.message.reply_text(format_profile_summary(profiler.summary()), parse_mode="HTML")
+
+def _admin_allowed(request: Request) -> bool:
+    token = request.headers.get("x-admin-token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@app.api_route("/admin/profile", methods=["GET", "POST", "DELETE"])
+async def admin_profile_handler(request: Request, updates: int = 0, sample: float = 0.0):
+    if not _admin_allowed(request):
+        return JSONResponse({"error": "not found"}, status_code=404)
+    if request.method == "POST":
+        profiler.start(updates, sample)
+    elif request.method == "DELETE":
+        profiler.start(0, 0)
+    return profiler.summary()
+
+@app.get("/admin/profile.pstats")
+async def admin_profile_dump(request: Request):
+    if not _admin_allowed(request):
+        return JSONResponse({"error": "not found"}, status_code=404)
+    data = profiler.dump()
+    if data is None:
+        return JSONResponse({"error": "профиль пуст или ещё собирается"}, status_code=409)
+    return Response(
+        data, media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="postapi.pstats"'}
+    )
+
+# Агрегация для /common (ИСПРАВЛЕННАЯ ВЕРСИЯ)
+# ------------------------------
+async def get_common_data_aggregated(tenant, date_from: str, date_to: str):
+    total = {
+        "click_count": 0,
+        "click_unique": 0,
+        "conf_count": 0,
+        "conf_payout": 0.0
+    }
+    return await _cached_aggregate(tenant, "common", date_from, date_to, _fetch_common_range, total)
+
+def _merge_totals(results, total: dict):
+    """Складывает итоги по дням из всех шардов; первая ошибка прерывает агрегацию"""
+    for ok, info in results:
+        if not ok:
+            return False, info
+        for values in info.values():
+            for key in total:
+                total[key] += values.get(key, 0)
+    return True, total
+
+async def _fetch_common_range(tenant, date_from: str, date_to: str):
+    return await alanbase_flight.do(
+        (tenant.name, "common", date_from, date_to),
+        lambda: _load_common_range(tenant, date_from, date_to)
+    )
+
+async def _load_common_range(tenant, date_from: str, date_to: str):
+    try:
+        logger.info(f"Запрос /common за период: {date_from} - {date_to}")
+        
+        r = await alanbase_get(
+            tenant,
+            "common",
+            params={
+                "group_by": "day",
+                "timezone": "Europe/Moscow",
+                "date_from": date_from.split()[0],  # Берем только дату
+                "date_to": date_to.split()[0],      # Без времени
+                "currency_code": "USD"
+            }
+        )
+
+        if r.status_code != 200:
+            return False, f"Ошибка /common {r.status_code}: {r.text}"
+        
+        with profile_phase("json"):
+            data = r.json()
+        arr = data.get("data", [])
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Сырые данные API: %s", json.dumps(arr, ensure_ascii=False))
+        
+        # Итоги по дням: их же раскладывает по дням кэш закрытых дней
+        by_day = {}
+        
+        series = series_for(tenant)
+        with profile_phase("aggregate"):
+            for item in arr:
+                day = str(item["day"])[:10] if item.get("day") else None
+                total = by_day.get(day)
+                if total is None:
+                    total = by_day[day] = {"click_count": 0, "click_unique": 0, "conf_count": 0, "conf_payout": 0.0}
+                clicks = int(item.get("click_count", 0))
+                unique = int(item.get("click_unique_count", 0))
+                total["click_count"] += clicks
+                total["click_unique"] += unique
+            
+                conversions = item.get("conversions", {})
+                confirmed = conversions.get("confirmed", {})
+            
+                # Проверка типа данных для конверсий
+                if isinstance(confirmed, dict):
+                    conf_count = int(confirmed.get("count", 0))
+                    conf_payout = float(confirmed.get("payout", 0))
+                    total["conf_count"] += conf_count
+                    total["conf_payout"] += conf_payout
+                else:
+                    conf_count, conf_payout = 0, 0.0
+                    logger.warning(f"Некорректный формат конверсий: {type(confirmed)}")
+                if series is not None and day:
+                    series.put_common(day, clicks, unique, conf_count, conf_payout)
+
+        logger.info(f"Итоговая агрегация по {len(by_day)} дн.")
+        return True, by_day
+        
+    except Exception as e:
+        logger.error(f"Критическая ошибка в _load_common_range: {str(e)}")
+        return False, f"Ошибка обработки данных: {str(e)}"
+
+# ------------------------------
+# Агрегация для /conversions (registration, ftd, rdeposit)
+# ------------------------------
+async def get_rfr_aggregated(tenant, date_from: str, date_to: str):
+    out = {"registration": 0, "ftd": 0, "rdeposit": 0}
+    return await _cached_aggregate(tenant, "conversions", date_from, date_to, _fetch_rfr_range, out)
+
+async def _fetch_rfr_range(tenant, date_from: str, date_to: str):
+    return await alanbase_flight.do(
+        (tenant.name, "conversions", date_from, date_to),
+        lambda: _load_rfr_range(tenant, date_from, date_to)
+    )
+
+def _count_goal(out: dict, row: dict):
+    g = (row.get("goal") or {}).get("key")
+    if g in out:
+        out[g] += 1
+
+async def _load_rfr_range(tenant, date_from: str, date_to: str):
+    by_day = {}
+    series = series_for(tenant)
+    # Неполные дни в хранилище рядов не попадают — там только целые сутки
+    columns = series.builder() if series is not None and _whole_days(date_from, date_to) else None
+
+    def on_row(row):
+        day = _row_day(row)
+        out = by_day.get(day)
+        if out is None:
+            out = by_day[day] = {"registration": 0, "ftd": 0, "rdeposit": 0}
+        _count_goal(out, row)
+        if columns is not None:
+            columns.add(row)
+
+    try:
+        ok, info = await fetch_conversions(tenant, date_from, date_to, on_row)
+        if not ok:
+            return False, info
+        if columns is not None:
+            columns.commit(_days_between(date_from, date_to))
+        return True, by_day
+    except Exception as e:
+        return False, str(e)
+
+# ------------------------------
+# Постраничная загрузка /conversions
+# ------------------------------
+GOAL_KEYS = ["registration", "ftd", "rdeposit"]
+
+def _range_days(date_from: str, date_to: str) -> int:
+    start = datetime.strptime(date_from[:10], "%Y-%m-%d").date()
+    end = datetime.strptime(date_to[:10], "%Y-%m-%d").date()
+    return (end - start).days + 1
+
+def adaptive_per_page(tenant, date_from: str, date_to: str) -> int:
+    """per_page по ожидаемому числу строк: малый период укладывается в одну страницу"""
+    estimate = tenant.rows_per_day
+    if estimate is None:
+        return ALANBASE_MAX_PER_PAGE
+    expected = int(estimate * _range_days(date_from, date_to) * 1.25) + 1
+    return max(ALANBASE_MIN_PER_PAGE, min(ALANBASE_MAX_PER_PAGE, expected))
+
+def _learn_rows_per_day(tenant, total: int, date_from: str, date_to: str):
+    per_day = total / _range_days(date_from, date_to)
+    prev = tenant.rows_per_day
+    tenant.rows_per_day = per_day if prev is None else prev * 0.7 + per_day * 0.3
+
+def _last_page_from_meta(meta, per_page: int):
+    """Номер последней страницы из meta ответа или None, если meta нет"""
+    if not isinstance(meta, dict):
+        return None, None
+    for key in ("last_page", "total_pages", "page_count", "pages"):
+        if isinstance(meta.get(key), int):
+            total = meta.get("total_count", meta.get("total"))
+            return meta[key], total if isinstance(total, int) else None
+    for key in ("total_count", "total", "count"):
+        if isinstance(meta.get(key), int):
+            return max(1, -(-meta[key] // per_page)), meta[key]
+    return None, None
+
+async def _load_conversions_page(tenant, date_from, date_to, page: int, per_page: int, on_row, goal_keys):
+    """Одна страница /conversions → (True, (строк, meta)) или (False, ошибка)"""
+    params = [
+        ("timezone", "Europe/Moscow"),
+        ("date_from", date_from),
+        ("date_to", date_to),
+        ("per_page", str(per_page)),
+        ("page", str(page)),
+        ("group_by", "day")
+    ]
+    for key in goal_keys:
+        params.append(("goal_keys[]", key))
+
+    if ALANBASE_STREAM_PARSE:
+        status, parsed = await alanbase_stream(tenant, "conversions", params, on_row)
+        if status != 200:
+            return False, f"Ошибка /conversions {status}: {parsed}"
+        return True, (parsed.rows, parsed.extra.get("meta"))
+
+    resp = await alanbase_get(tenant, "conversions", params)
+    if resp.status_code != 200:
+        return False, f"Ошибка /conversions {resp.status_code}: {resp.text}"
+    with profile_phase("json"):
+        body = resp.json()
+    arr = body.get("data", [])
+    for c in arr:
+        on_row(c)
+    return True, (len(arr), body.get("meta"))
+
+async def fetch_conversions(tenant, date_from: str, date_to: str, on_row, goal_keys=GOAL_KEYS, parallel: bool = True):
+    """Проходит все страницы /conversions, передавая строки в on_row.
+
+    Число страниц берётся из meta первого ответа, остальные страницы
+    качаются параллельно (в пределах ALANBASE_CONCURRENCY). Без meta —
+    последовательно до неполной страницы, без лишнего пустого запроса.
+    """
+    per_page = adaptive_per_page(tenant, date_from, date_to)
+    ok, info = await _load_conversions_page(tenant, date_from, date_to, 1, per_page, on_row, goal_keys)
+    if not ok:
+        return False, info
+    rows, meta = info
+    last_page, total = _last_page_from_meta(meta, per_page)
+
+    if last_page is not None and last_page > 1:
+        pages = range(2, last_page + 1)
+        if parallel:
+            results = await asyncio.gather(
+                *(_load_conversions_page(tenant, date_from, date_to, p, per_page, on_row, goal_keys) for p in pages)
+            )
+        else:
+            results = []
+            for p in pages:
+                results.append(await _load_conversions_page(tenant, date_from, date_to, p, per_page, on_row, goal_keys))
+                if not results[-1][0]:
+                    break
+        for ok, page_info in results:
+            if not ok:
+                return False, page_info
+            rows += page_info[0]
+    elif last_page is None:
+        page, page_rows = 1, rows
+        while page_rows >= per_page:
+            page += 1
+            ok, page_info = await _load_conversions_page(tenant, date_from, date_to, page, per_page, on_row, goal_keys)
+            if not ok:
+                return False, page_info
+            page_rows = page_info[0]
+            rows += page_rows
+
+    if list(goal_keys) == GOAL_KEYS:
+        # Оценка объёма нужна для запросов по целям статистики, выгрузка «всех целей» её не трогает
+        _learn_rows_per_day(tenant, total if total is not None else rows, date_from, date_to)
+    return True, rows
+
+# ------------------------------
+# Колоночное хранилище рядов (дни × sub_id)
+# ------------------------------
+GOAL_CODES = {"registration": 1, "ftd": 2, "rdeposit": 3}
+SUB_ID_COLUMNS = ("sub_id3", "sub_id4", "sub_id5")
+
+def _whole_days(date_from: str, date_to: str) -> bool:
+    return (len(date_from) <= 10 or date_from[11:16] == "00:00") and (len(date_to) <= 10 or date_to[11:16] == "23:59")
+
+def _days_between(date_from: str, date_to: str) -> list:
+    start = datetime.strptime(date_from[:10], "%Y-%m-%d").date()
+    return [str(start + timedelta(days=i)) for i in range(_range_days(date_from, date_to))]
+
+def _row_day(row: dict):
+    value = row.get("datetime") or row.get("conversion_datetime") or row.get("date")
+    return str(value)[:10] if value else None
+
+class DayColumns:
+    """Один день аккаунта: итоги /common и колонки строк /conversions"""
+    __slots__ = ("common", "goal", "payout", "sub_id3", "sub_id4", "sub_id5")
+
+    def __init__(self):
+        self.common = None  # array('d'): клики, уники, подтверждённые, выплата
+        self.goal = None    # array('B'): код цели из GOAL_CODES (0 — прочие)
+        self.payout = None  # array('d')
+        self.sub_id3 = self.sub_id4 = self.sub_id5 = None  # array('I'): коды строк словаря
+
+class ConversionColumnsBuilder:
+    """Копит строки /conversions по дням, в хранилище они попадают целиком в commit()"""
+
+    def __init__(self, store):
+        self._store = store
+        self._days = {}
+
+    def add(self, row: dict):
+        day = _row_day(row)
+        if day is None:
+            return
+        cols = self._days.get(day)
+        if cols is None:
+            cols = self._days[day] = (array("B"), array("d"), array("I"), array("I"), array("I"))
+        goal, payout, sub3, sub4, sub5 = cols
+        goal.append(GOAL_CODES.get((row.get("goal") or {}).get("key"), 0))
+        payout.append(_parse_revenue(row.get("payout")))
+        code = self._store.code
+        sub3.append(code(row.get("sub_id3")))
+        sub4.append(code(row.get("sub_id4")))
+        sub5.append(code(row.get("sub_id5")))
+
+    def commit(self, days: list):
+        """Заменяет колонки конверсий за days (дни без строк — пустые)"""
+        empty = (array("B"), array("d"), array("I"), array("I"), array("I"))
+        for day in days:
+            cols = self._days.get(day, empty)
+            entry = self._store.day(day)
+            entry.goal, entry.payout, entry.sub_id3, entry.sub_id4, entry.sub_id5 = cols
+        self._store.trim()
+
+class SeriesStore:
+    """Ряды одного аккаунта по дням в компактных массивах; sub_id — через словарь строк.
+
+    Дни вытесняются по давности использования, а не по дате: только что
+    запрошенный старый период не должен выпадать сразу после загрузки.
+    """
+
+    def __init__(self, max_days: int):
+        self._max_days = max_days
+        self._days = OrderedDict()
+        self._strings = [""]
+        self._codes = {"": 0}
 
-# ------------------------------
-# /start
-# ------------------------------
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # 🔒 Проверка доступа
-    if not await check_access(update):
-        return
+    def code(self, value) -> int:
+        text = "" if value is None else str(value)
+        code = self._codes.get(text)
+        if code is None:
+            code = self._codes[text] = len(self._strings)
+            self._strings.append(text)
+        return code
 
-    txt = "Привет! Выберите команду:"
-    mk = get_main_menu()
-    await update.message.reply_text(txt, parse_mode="HTML", reply_markup=mk)
+    def day(self, day: str) -> DayColumns:
+        entry = self._days.get(day)
+        if entry is None:
+            entry = self._days[day] = DayColumns()
+        else:
+            self._days.move_to_end(day)
+        return entry
 
-# Агрегация для /common (ИСПРАВЛЕННАЯ ВЕРСИЯ)
-# ------------------------------
-async def get_common_data_aggregated(date_from: str, date_to: str):
-    try:
-        logger.info(f"Запрос /common за период: {date_from} - {date_to}")
-        
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(
-                f"{BASE_API_URL}/partner/statistic/common",
-                headers={"API-KEY": API_KEY},
-                params={
-                    "group_by": "day",
-                    "timezone": "Europe/Moscow",
-                    "date_from": date_from.split()[0],  # Берем только дату
-                    "date_to": date_to.split()[0],      # Без времени
-                    "currency_code": "USD"
-                }
-            )
+    def put_common(self, day: str, clicks: int, unique: int, conf_count: int, conf_payout: float):
+        self.day(day).common = array("d", (clicks, unique, conf_count, conf_payout))
+        self.trim()
 
-        if r.status_code != 200:
-            return False, f"Ошибка /common {r.status_code}: {r.text}"
-        
-        data = r.json()
-        arr = data.get("data", [])
-        
-        logger.debug(f"Сырые данные API: {json.dumps(arr, ensure_ascii=False)}")
-        
-        # Обнуляем счетчики
-        total = {
-            "click_count": 0,
-            "click_unique": 0,
-            "conf_count": 0,
-            "conf_payout": 0.0
-        }
-        
-        for item in arr:
-            total["click_count"] += int(item.get("click_count", 0))
-            total["click_unique"] += int(item.get("click_unique_count", 0))
-            
-            conversions = item.get("conversions", {})
-            confirmed = conversions.get("confirmed", {})
-            
-            # Проверка типа данных для конверсий
-            if isinstance(confirmed, dict):
-                total["conf_count"] += int(confirmed.get("count", 0))
-                total["conf_payout"] += float(confirmed.get("payout", 0))
-            else:
-                logger.warning(f"Некорректный формат конверсий: {type(confirmed)}")
+    def builder(self) -> ConversionColumnsBuilder:
+        return ConversionColumnsBuilder(self)
 
-        logger.info(f"Итоговая агрегация: {total}")
-        return True, total
-        
-    except Exception as e:
-        logger.error(f"Критическая ошибка в get_common_data_aggregated: {str(e)}")
-        return False, f"Ошибка обработки данных: {str(e)}"
+    def trim(self):
+        if len(self._days) <= self._max_days:
+            return
+        while len(self._days) > self._max_days:
+            self._days.popitem(last=False)
+        if len(self._strings) > 65536:
+            self._compact()
 
-# ------------------------------
-# Агрегация для /conversions (registration, ftd, rdeposit)
-# ------------------------------
-async def get_rfr_aggregated(date_from: str, date_to: str):
-    out = {"registration": 0, "ftd": 0, "rdeposit": 0}
-    page = 1
-    goal_keys = ["registration", "ftd", "rdeposit"]
+    def _compact(self):
+        """Пересобирает словарь sub_id, выбрасывая строки вытесненных дней"""
+        old = self._strings
+        self._strings, self._codes = [""], {"": 0}
+        for entry in self._days.values():
+            for name in SUB_ID_COLUMNS:
+                column = getattr(entry, name)
+                if column is not None:
+                    setattr(entry, name, array("I", (self.code(old[c]) for c in column)))
 
-    try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            while True:
-                params = [
-                    ("timezone", "Europe/Moscow"),
-                    ("date_from", date_from),
-                    ("date_to", date_to),
-                    ("per_page", "500"),
-                    ("page", str(page)),
-                    ("group_by", "day")
-                ]
-                for key in goal_keys:
-                    params.append(("goal_keys[]", key))
-
-                resp = await client.get(
-                    f"{BASE_API_URL}/partner/statistic/conversions",
-                    headers={"API-KEY": API_KEY},
-                    params=params
-                )
+    def missing(self, days: list):
+        """(дни без /common, дни без /conversions); имеющиеся дни становятся свежими"""
+        no_common, no_conv = [], []
+        for day in days:
+            entry = self._days.get(day)
+            if entry is not None:
+                self._days.move_to_end(day)
+            if entry is None or entry.common is None:
+                no_common.append(day)
+            if entry is None or entry.goal is None:
+                no_conv.append(day)
+        return no_common, no_conv
 
-                if resp.status_code != 200:
-                    return False, f"Ошибка /conversions {resp.status_code}: {resp.text}"
+    def per_day(self, days: list) -> dict:
+        """day → [клики, уники, подтв., выплата, рег, FTD, RD]"""
+        out = {}
+        for day in days:
+            entry = self._days.get(day)
+            row = [0.0] * 7
+            if entry is not None:
+                if entry.common is not None:
+                    row[:4] = entry.common
+                if entry.goal is not None:
+                    counts = [0, 0, 0, 0]
+                    for g in entry.goal:
+                        counts[g] += 1
+                    row[4:] = counts[1:]
+            out[day] = row
+        return out
 
-                arr = resp.json().get("data", [])
-                if not arr:
-                    break  # нет данных — завершаем
+    def group_by(self, days: list, column: str) -> dict:
+        """sub_id → [рег, FTD, RD, выплата] за days одним проходом по колонкам"""
+        size = len(self._strings)
+        counts = [0] * (size * 4)
+        payout = [0.0] * size
+        for day in days:
+            entry = self._days.get(day)
+            if entry is None or entry.goal is None:
+                continue
+            codes = getattr(entry, column)
+            for code, g in zip(codes, entry.goal):
+                counts[code * 4 + g] += 1
+            for code, p in zip(codes, entry.payout):
+                payout[code] += p
+        out = {}
+        for code in range(size):
+            base = code * 4
+            if counts[base] or counts[base + 1] or counts[base + 2] or counts[base + 3]:
+                out[self._strings[code]] = [counts[base + 1], counts[base + 2], counts[base + 3], payout[code]]
+        return out
 
-                for c in arr:
-                    g = c.get("goal", {}).get("key")
-                    if g in out:
-                        out[g] += 1
+series_stores = {}
 
-                page += 1  # следующая страница
+def series_for(tenant):
+    if SERIES_MAX_DAYS <= 0:
+        return None
+    store = series_stores.get(tenant.name)
+    if store is None:
+        store = series_stores[tenant.name] = SeriesStore(SERIES_MAX_DAYS)
+    return store
 
-        return True, out
-    except Exception as e:
-        return False, str(e)
+async def ensure_series(tenant, date_from: str, date_to: str):
+    """Докачивает в хранилище рядов дни периода, которых там ещё нет"""
+    store = series_for(tenant)
+    if store is None:
+        return False, "Хранилище рядов выключено (SERIES_MAX_DAYS=0)"
+    days = _days_between(date_from, date_to)
+    if len(days) > SERIES_MAX_DAYS:
+        return False, f"Период длиннее {SERIES_MAX_DAYS} дн. — разбивка недоступна"
+    no_common, no_conv = store.missing(days)
+    bounds = (f"{days[0]} 00:00", f"{days[-1]} 23:59")
+    runs_common = _day_runs([datetime.strptime(d, "%Y-%m-%d").date() for d in no_common], *bounds)
+    runs_conv = _day_runs([datetime.strptime(d, "%Y-%m-%d").date() for d in no_conv], *bounds)
+    results = await asyncio.gather(
+        *(_fetch_common_range(tenant, f, t) for f, t in runs_common),
+        *(_fetch_rfr_range(tenant, f, t) for f, t in runs_conv)
+    )
+    for ok, info in results:
+        if not ok:
+            return False, info
+    # Пока шла загрузка, параллельный запрос другого периода мог вытеснить эти дни;
+    # читать их нужно сразу после проверки, без await между ними
+    if any(store.missing(days)):
+        return False, "Хранилище рядов занято другими периодами — повторите запрос"
+    return True, days
+
+async def series_per_day(scope: tuple, date_from: str, date_to: str):
+    """Таблица по дням для выбранных аккаунтов"""
+    total = {}
+    for name in scope:
+        tenant = tenants[name]
+        ok, days = await ensure_series(tenant, date_from, date_to)
+        if not ok:
+            return False, days
+        for day, row in series_for(tenant).per_day(days).items():
+            acc = total.setdefault(day, [0.0] * 7)
+            for i, value in enumerate(row):
+                acc[i] += value
+    return True, total
+
+async def series_top(scope: tuple, date_from: str, date_to: str, column: str):
+    """Разбивка конверсий по sub_id для выбранных аккаунтов"""
+    total = {}
+    for name in scope:
+        tenant = tenants[name]
+        ok, days = await ensure_series(tenant, date_from, date_to)
+        if not ok:
+            return False, days
+        for key, row in series_for(tenant).group_by(days, column).items():
+            acc = total.setdefault(key, [0, 0, 0, 0.0])
+            for i, value in enumerate(row):
+                acc[i] += value
+    return True, total
 
 # ------------------------------
 # Формирование итогового текста статистики
@@ -305,6 +2411,443 @@ def build_metrics(clicks, unique_clicks, reg, ftd, conf_payout, rd):
         f"• <b>uEPC</b> = {uepc:.3f} USD\n"
     )
 
+# ------------------------------
+# Стандартные периоды
+# ------------------------------
+PERIODS = {
+    "period_today": (0, "Сегодня"),
+    "period_7days": (6, "Последние 7 дней"),
+    "period_month": (29, "Последние 30 дней")
+}
+
+def period_range(key: str):
+    days_back, label = PERIODS[key]
+    end_ = datetime.now().date()
+    start_ = end_ - timedelta(days=days_back)
+    return f"{start_} 00:00", f"{end_} 23:59", label
+
+# ------------------------------
+# Фоновый прогрев стандартных периодов
+# ------------------------------
+prewarmed = {}
+_prewarm_task = None
+
+async def prewarm_periods() -> bool:
+    """Обновляет снимки стандартных периодов каждого аккаунта; True, если все успешны"""
+    jobs = [((name,), key, period_range(key)) for name in tenants for key in PERIODS]
+    results = await asyncio.gather(*(collect_scope_stats(scope, f, t) for scope, _, (f, t, _) in jobs))
+    all_ok = True
+    for (scope, key, (date_from, date_to, _)), (ok, stats) in zip(jobs, results):
+        if ok:
+            prewarmed[(scope, key)] = (time.time(), date_from, date_to, stats)
+        else:
+            all_ok = False
+            logger.warning(f"Прогрев {scope[0]} {key} не удался: {stats}")
+    return all_ok
+
+def get_prewarmed(scope: tuple, key: str, date_from: str, date_to: str):
+    """Свежий снимок периода (fetched_at, stats) или None"""
+    entry = prewarmed.get((scope, key))
+    if entry is None:
+        return None
+    fetched_at, w_from, w_to, stats = entry
+    if (w_from, w_to) != (date_from, date_to) or time.time() - fetched_at > PREWARM_MAX_AGE:
+        return None
+    return fetched_at, stats
+
+async def _prewarm_loop():
+    while True:
+        await asyncio.sleep(PREWARM_INTERVAL)
+        try:
+            await prewarm_periods()
+        except Exception as e:
+            logger.error(f"Ошибка фонового прогрева: {e}")
+
+def start_prewarm_scheduler():
+    global _prewarm_task
+    if PREWARM_INTERVAL > 0 and _prewarm_task is None:
+        _prewarm_task = asyncio.create_task(_prewarm_loop())
+        logger.info(f"Фоновый прогрев периодов каждые {PREWARM_INTERVAL:g} с")
+
+def stop_prewarm_scheduler():
+    global _prewarm_task
+    if _prewarm_task is not None:
+        _prewarm_task.cancel()
+        _prewarm_task = None
+
+# ------------------------------
+# Хранилище снимков статистики (LRU + TTL)
+# ------------------------------
+def format_age(seconds: float) -> str:
+    if seconds < 60:
+        return f"{int(seconds)} с"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин"
+    return f"{int(seconds // 3600)} ч {int(seconds % 3600 // 60)} мин"
+
+class StatsSnapshot:
+    """Числа одного экрана статистики; текст пересобирается через build_stats_text"""
+    __slots__ = (
+        "label", "date_from", "date_to", "clicks", "unique", "reg", "ftd", "rd",
+        "conf_count", "conf_payout", "rfr_source", "tenants", "failed_tenants",
+        "closed", "closed_until", "fetched_at", "created_at", "stale", "common_missing", "live_at"
+    )
+
+    def __init__(self, label, date_from, date_to, stats: dict, fetched_at: float = None, stale: bool = False):
+        self.label = label
+        self.date_from = date_from
+        self.date_to = date_to
+        self.clicks = stats["click_count"]
+        self.unique = stats["click_unique"]
+        self.reg = stats["registration"]
+        self.ftd = stats["ftd"]
+        self.rd = stats["rdeposit"]
+        self.conf_count = stats["conf_count"]
+        self.conf_payout = stats["conf_payout"]
+        self.rfr_source = stats.get("rfr_source", "api")
+        self.tenants = stats.get("tenants")
+        self.failed_tenants = stats.get("failed_tenants")
+        self.closed = stats.get("closed")
+        self.closed_until = stats.get("closed_until")
+        self.common_missing = bool(stats.get("common_missing"))
+        self.live_at = stats.get("live_at")
+        self.created_at = time.time()
+        self.fetched_at = fetched_at or self.created_at
+        self.stale = stale
+
+    def base_text(self) -> str:
+        date_lbl = f"{self.date_from[:10]} .. {self.date_to[:10]}"
+        if self.common_missing:
+            clicks = unique = conf_count = "н/д"
+        else:
+            clicks, unique, conf_count = self.clicks, self.unique, self.conf_count
+        text = build_stats_text(
+            self.label, date_lbl, clicks, unique, self.reg, self.ftd, self.rd, conf_count, self.conf_payout
+        )
+        if len(tenants) > 1 and self.tenants:
+            text += f"\n🏷 Аккаунт: <b>{scope_label(self.tenants)}</b>\n"
+        if self.failed_tenants:
+            text += f"⚠️ <i>Без данных аккаунтов: {', '.join(self.failed_tenants)}</i>\n"
+        if self.rfr_source == "ledger":
+            text += "\n📒 <i>Регистрации/FTD/RD — из локального журнала postback'ов</i>\n"
+        if self.common_missing:
+            text += "⚠️ <i>Alanbase /common недоступен: клики не известны, доход — сумма postback'ов журнала</i>\n"
+        age = time.time() - self.fetched_at
+        if self.live_at:
+            live = datetime.fromtimestamp(self.live_at, MSK_TZ).strftime("%H:%M:%S")
+            at = datetime.fromtimestamp(self.fetched_at, MSK_TZ).strftime("%H:%M")
+            text += (
+                f"\n🔴 <i>Конверсии — live на {live} МСК; клики — "
+                f"на {at} МСК ({format_age(age)} назад)</i>\n"
+            )
+        elif age >= 30:
+            at = datetime.fromtimestamp(self.fetched_at, MSK_TZ).strftime("%H:%M")
+            text += f"\n🕒 <i>Данные на {at} МСК ({format_age(age)} назад)</i>\n"
+        if self.stale:
+            text += "⚠️ <i>Alanbase сейчас не отвечает — показаны сохранённые данные</i>\n"
+        return text
+
+    def metrics_text(self) -> str:
+        if self.common_missing:
+            return "🎯 <b>Метрики:</b>\n\n<i>Недоступны: нет данных о кликах из Alanbase</i>"
+        return build_metrics(self.clicks, self.unique, self.reg, self.ftd, self.conf_payout, self.rd)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        snap = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(snap, name, data.get(name))
+        return snap
+
+class SnapshotStore:
+    """Ограниченное хранилище снимков: вытесняет старые по LRU и по TTL"""
+
+    def __init__(self, capacity: int, ttl: float):
+        self._capacity = capacity
+        self._ttl = ttl
+        self._items = OrderedDict()
+
+    def put(self, snap: StatsSnapshot) -> str:
+        uniq_id = uuid.uuid4().hex[:8]
+        self._items[uniq_id] = snap
+        while len(self._items) > self._capacity:
+            self._items.popitem(last=False)
+        return uniq_id
+
+    def get(self, uniq_id: str):
+        snap = self._items.get(uniq_id)
+        if snap is None:
+            return None
+        if time.time() - snap.created_at > self._ttl:
+            del self._items[uniq_id]
+            return None
+        self._items.move_to_end(uniq_id)
+        return snap
+
+    def __len__(self):
+        return len(self._items)
+
+# ------------------------------
+# Общее состояние (несколько воркеров)
+# ------------------------------
+class StateBackend(ABC):
+    """Состояние диалога по пользователю и снимки статистики.
+
+    Методы асинхронные, чтобы можно было добавить сетевое хранилище (Redis и т.п.)
+    """
+
+    @abstractmethod
+    async def get_value(self, user_id, key: str, default=None):
+        ...
+
+    @abstractmethod
+    async def set_value(self, user_id, key: str, value):
+        ...
+
+    @abstractmethod
+    async def pop_value(self, user_id, key: str, default=None):
+        ...
+
+    @abstractmethod
+    async def put_snapshot(self, snap: StatsSnapshot) -> str:
+        ...
+
+    @abstractmethod
+    async def get_snapshot(self, uniq_id: str):
+        ...
+
+    def close(self):
+        pass
+
+class MemoryStateBackend(StateBackend):
+    """Состояние в памяти процесса (один воркер)"""
+
+    def __init__(self, capacity: int, ttl: float):
+        self._values = {}
+        self._snapshots = SnapshotStore(capacity, ttl)
+
+    async def get_value(self, user_id, key: str, default=None):
+        return self._values.get((user_id, key), default)
+
+    async def set_value(self, user_id, key: str, value):
+        self._values[(user_id, key)] = value
+
+    async def pop_value(self, user_id, key: str, default=None):
+        return self._values.pop((user_id, key), default)
+
+    async def put_snapshot(self, snap: StatsSnapshot) -> str:
+        return self._snapshots.put(snap)
+
+    async def get_snapshot(self, uniq_id: str):
+        return self._snapshots.get(uniq_id)
+
+class SQLiteStateBackend(StateBackend):
+    """Состояние в SQLite-файле, общем для всех процессов на машине"""
+
+    def __init__(self, path: str, capacity: int, ttl: float):
+        self._capacity = capacity
+        self._ttl = ttl
+        self._conn = _open_sqlite(path)
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_state ("
+                "user_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (user_id, key))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                "id TEXT PRIMARY KEY, created_at REAL NOT NULL, payload TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_snapshots_created ON snapshots (created_at)")
+
+    def _get(self, user_id, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM user_state WHERE user_id = ? AND key = ?", (str(user_id), key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, user_id, key, value):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_state (user_id, key, value) VALUES (?, ?, ?)",
+                (str(user_id), key, json.dumps(value))
+            )
+
+    def _pop(self, user_id, key):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM user_state WHERE user_id = ? AND key = ?", (str(user_id), key)
+            ).fetchone()
+            self._conn.execute("DELETE FROM user_state WHERE user_id = ? AND key = ?", (str(user_id), key))
+        return json.loads(row[0]) if row else None
+
+    def _put_snapshot(self, snap: StatsSnapshot) -> str:
+        uniq_id = uuid.uuid4().hex[:8]
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO snapshots (id, created_at, payload) VALUES (?, ?, ?)",
+                (uniq_id, snap.created_at, json.dumps(snap.to_dict(), ensure_ascii=False))
+            )
+            self._conn.execute("DELETE FROM snapshots WHERE created_at < ?", (time.time() - self._ttl,))
+            self._conn.execute(
+                "DELETE FROM snapshots WHERE id NOT IN "
+                "(SELECT id FROM snapshots ORDER BY created_at DESC LIMIT ?)",
+                (self._capacity,)
+            )
+        return uniq_id
+
+    def _get_snapshot(self, uniq_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_at, payload FROM snapshots WHERE id = ?", (uniq_id,)
+            ).fetchone()
+        if not row or time.time() - row[0] > self._ttl:
+            return None
+        return StatsSnapshot.from_dict(json.loads(row[1]))
+
+    async def get_value(self, user_id, key: str, default=None):
+        value = await asyncio.to_thread(self._get, user_id, key)
+        return default if value is None else value
+
+    async def set_value(self, user_id, key: str, value):
+        await asyncio.to_thread(self._set, user_id, key, value)
+
+    async def pop_value(self, user_id, key: str, default=None):
+        value = await asyncio.to_thread(self._pop, user_id, key)
+        return default if value is None else value
+
+    async def put_snapshot(self, snap: StatsSnapshot) -> str:
+        return await asyncio.to_thread(self._put_snapshot, snap)
+
+    async def get_snapshot(self, uniq_id: str):
+        return await asyncio.to_thread(self._get_snapshot, uniq_id)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+state: StateBackend = MemoryStateBackend(STATS_STORE_CAPACITY, STATS_STORE_TTL)
+
+def open_state_backend():
+    global state
+    if STATE_BACKEND == "sqlite":
+        state = SQLiteStateBackend(STATE_DB_PATH, STATS_STORE_CAPACITY, STATS_STORE_TTL)
+        logger.info(f"Состояние бота хранится в SQLite: {STATE_DB_PATH}")
+    elif STATE_BACKEND != "memory":
+        logger.warning(f"Неизвестный STATE_BACKEND={STATE_BACKEND}, используем memory")
+
+async def current_scope(user_id, chat_id) -> tuple:
+    """Выбранные пользователем аккаунты (по умолчанию — основной аккаунт чата)"""
+    allowed = tenants_for_chat(chat_id)
+    if not allowed:
+        return (default_tenant.name,)
+    chosen = await state.get_value(user_id, "tenant_scope")
+    if chosen == ALL_TENANTS and len(allowed) > 1:
+        return tuple(t.name for t in allowed)
+    for tenant in allowed:
+        if tenant.name == chosen:
+            return (tenant.name,)
+    return (allowed[0].name,)
+
+def scope_label(scope) -> str:
+    if len(scope) > 1:
+        return "Все аккаунты"
+    return scope[0]
+
+async def period_menu(user_id, chat_id):
+    """Текст и клавиатура выбора периода; при нескольких аккаунтах — ещё и выбор аккаунта"""
+    rows = [
+        [
+            InlineKeyboardButton("Сегодня", callback_data="period_today"),
+            InlineKeyboardButton("7 дней", callback_data="period_7days"),
+            InlineKeyboardButton("За месяц", callback_data="period_month")
+        ],
+        [InlineKeyboardButton("Свой период", callback_data="period_custom")]
+    ]
+    text = "Выберите период:"
+    allowed = tenants_for_chat(chat_id)
+    if len(allowed) > 1:
+        scope = await current_scope(user_id, chat_id)
+        selected = ALL_TENANTS if len(scope) > 1 else scope[0]
+        choices = [(t.name, t.name) for t in allowed] + [("Все аккаунты", ALL_TENANTS)]
+        rows.append([
+            InlineKeyboardButton(("✅ " if value == selected else "") + title, callback_data=f"scope|{value}")
+            for title, value in choices
+        ])
+        text = f"Аккаунт: <b>{scope_label(scope)}</b>\nВыберите период:"
+    rows.append([InlineKeyboardButton("Назад", callback_data="back_menu")])
+    return text, InlineKeyboardMarkup(rows)
+
+def stats_keyboard(uniq_id: str, metrics_shown: bool = False) -> InlineKeyboardMarkup:
+    if metrics_shown:
+        toggle = InlineKeyboardButton("Скрыть метрики", callback_data=f"hide|{uniq_id}")
+    else:
+        toggle = InlineKeyboardButton("✨ Рассчитать метрики", callback_data=f"metrics|{uniq_id}")
+    rows = [[toggle]]
+    if SERIES_MAX_DAYS > 0:
+        rows.append([
+            InlineKeyboardButton("📅 По дням", callback_data=f"days|{uniq_id}"),
+            InlineKeyboardButton("🏆 Кампании", callback_data=f"top|{uniq_id}|sub_id4|ftd"),
+            InlineKeyboardButton("Адсеты", callback_data=f"top|{uniq_id}|sub_id5|ftd")
+        ])
+    rows.append([
+        InlineKeyboardButton("Обновить", callback_data=f"update|{uniq_id}"),
+        InlineKeyboardButton("📥 CSV", callback_data=f"export|{uniq_id}")
+    ])
+    rows.append([InlineKeyboardButton("Назад", callback_data="back_periods")])
+    return InlineKeyboardMarkup(rows)
+
+def breakdown_keyboard(uniq_id: str, column: str = None, order: str = None) -> InlineKeyboardMarkup:
+    rows = []
+    if column is not None:
+        other = "payout" if order == "ftd" else "ftd"
+        rows.append([
+            InlineKeyboardButton(
+                "Сортировать по доходу" if other == "payout" else "Сортировать по FTD",
+                callback_data=f"top|{uniq_id}|{column}|{other}"
+            )
+        ])
+    rows.append([InlineKeyboardButton("Назад", callback_data=f"hide|{uniq_id}")])
+    return InlineKeyboardMarkup(rows)
+
+SUB_ID_TITLES = {"sub_id3": "подходов", "sub_id4": "кампаний", "sub_id5": "адсетов"}
+TOP_LIMIT = 10
+
+def format_per_day(snap, table: dict) -> str:
+    lines = [f"{'Дата':<5} {'Клики':>6} {'Рег':>4} {'FTD':>4} {'RD':>4} {'Доход':>8}"]
+    for day in sorted(table):
+        clicks, _, _, payout, reg, ftd, rd = table[day]
+        lines.append(f"{day[5:]:<5} {int(clicks):>6} {int(reg):>4} {int(ftd):>4} {int(rd):>4} {payout:>8.2f}")
+    header = f"📅 <b>По дням</b> ({snap.label})\n🗓 <i>{snap.date_from[:10]} .. {snap.date_to[:10]}</i>\n\n"
+    return header + "<pre>" + html.escape("\n".join(lines)) + "</pre>"
+
+def format_top(snap, groups: dict, column: str, order: str) -> str:
+    index = 1 if order == "ftd" else 3
+    ranked = sorted(groups.items(), key=lambda kv: (-kv[1][index], kv[0]))[:TOP_LIMIT]
+    title = SUB_ID_TITLES.get(column, column)
+    by = "FTD" if order == "ftd" else "доходу"
+    header = f"🏆 <b>Топ {title} по {by}</b> ({snap.label})\n🗓 <i>{snap.date_from[:10]} .. {snap.date_to[:10]}</i>\n\n"
+    if not ranked:
+        return header + "<i>Конверсий за период нет</i>"
+    lines = []
+    for pos, (name, (reg, ftd, rd, payout)) in enumerate(ranked, 1):
+        shown = html.escape(name[:40]) if name else "(не задано)"
+        lines.append(f"{pos}. <b>{shown}</b>\n    рег {reg} · FTD {ftd} · RD {rd} · {payout:.2f} USD")
+    return header + "\n".join(lines)
+
+async def show_expired(query):
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back_periods")]])
+    await query.edit_message_text(
+        "⌛ Данные этого экрана устарели. Выберите период заново.",
+        parse_mode="HTML",
+        reply_markup=kb
+    )
+
 # ------------------------------
 # Inline-хэндлер для кнопок
 # ------------------------------
@@ -317,38 +2860,23 @@ async def inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     data = query.data
 
-    if data == "back_menu":
-        kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("Сегодня", callback_data="period_today"),
-                InlineKeyboardButton("7 дней", callback_data="period_7days"),
-                InlineKeyboardButton("За месяц", callback_data="period_month")
-            ],
-            [InlineKeyboardButton("Свой период", callback_data="period_custom")],
-            [InlineKeyboardButton("Назад", callback_data="back_menu")]
-        ])
-        await query.edit_message_text("Выберите период:", parse_mode="HTML", reply_markup=kb)
-        return
-
-    elif data in ["period_today", "period_7days", "period_month"]:
-        if data == "period_today":
-            d_str = datetime.now().strftime("%Y-%m-%d")
-            date_from = f"{d_str} 00:00"
-            date_to = f"{d_str} 23:59"
-            label = "Сегодня"
-        elif data == "period_7days":
-            end_ = datetime.now().date()
-            start_ = end_ - timedelta(days=6)
-            date_from = f"{start_} 00:00"
-            date_to = f"{end_} 23:59"
-            label = "Последние 7 дней"
-        elif data == "period_month":
-            end_ = datetime.now().date()
-            start_ = end_ - timedelta(days=29)
-            date_from = f"{start_} 00:00"
-            date_to = f"{end_} 23:59"
-            label = "Последние 30 дней"
-        await show_stats_screen(query, context, date_from, date_to, label)
+    if data in ("back_menu", "back_periods"):
+        text, kb = await period_menu(query.from_user.id, query.message.chat_id)
+        await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
+        return
+
+    elif data.startswith("scope|"):
+        await state.set_value(query.from_user.id, "tenant_scope", data.split("|", 1)[1])
+        text, kb = await period_menu(query.from_user.id, query.message.chat_id)
+        await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
+        return
+
+    elif data in PERIODS:
+        date_from, date_to, label = period_range(data)
+        scope = await current_scope(query.from_user.id, query.message.chat_id)
+        # Счётчики дашборда свежее любого прогретого снимка
+        warm = live_today(scope, date_from, date_to) or get_prewarmed(scope, data, date_from, date_to)
+        await show_stats_screen(query, context, date_from, date_to, label, scope, prefetched=warm)
         return
 
     elif data == "period_custom":
@@ -361,73 +2889,80 @@ async def inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("Назад", callback_data="back_periods")]
         ])
         await query.edit_message_text(txt, parse_mode="HTML", reply_markup=kb)
-        context.user_data["awaiting_period"] = True
-        context.user_data["inline_msg_id"] = query.message.message_id
-        return
-
-    elif data == "back_periods":
-        kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("Сегодня", callback_data="period_today"),
-                InlineKeyboardButton("7 дней", callback_data="period_7days"),
-                InlineKeyboardButton("За месяц", callback_data="period_month")
-            ],
-            [InlineKeyboardButton("Свой период", callback_data="period_custom")],
-            [InlineKeyboardButton("Назад", callback_data="back_menu")]
-        ])
-        await query.edit_message_text("Выберите период:", parse_mode="HTML", reply_markup=kb)
+        await state.set_value(query.from_user.id, "awaiting_period", True)
+        await state.set_value(query.from_user.id, "inline_msg_id", query.message.message_id)
         return
 
     elif data.startswith("metrics|"):
         uniq_id = data.split("|")[1]
-        store = context.user_data.get("stats_store", {}).get(uniq_id)
-        if not store:
-            await query.edit_message_text("❗ Данные не найдены", parse_mode="HTML")
+        snap = await state.get_snapshot(uniq_id)
+        if not snap:
+            await show_expired(query)
             return
-        base_text = store["base_text"]
-        c_ = store["clicks"]
-        uc_ = store["unique"]
-        r_ = store["reg"]
-        f_ = store["ftd"]
-        rd_ = store["rd"]
-        confp = store["confp"]
-        metrics_txt = build_metrics(c_, uc_, r_, f_, confp, rd_)
-        final_txt = base_text + "\n" + metrics_txt
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Скрыть метрики", callback_data=f"hide|{uniq_id}")],
-            [InlineKeyboardButton("Обновить", callback_data=f"update|{uniq_id}")],
-            [InlineKeyboardButton("Назад", callback_data="back_periods")]
-        ])
-        await query.edit_message_text(final_txt, parse_mode="HTML", reply_markup=kb)
+        final_txt = snap.base_text() + "\n" + snap.metrics_text()
+        await query.edit_message_text(final_txt, parse_mode="HTML", reply_markup=stats_keyboard(uniq_id, True))
         return
 
     elif data.startswith("hide|"):
         uniq_id = data.split("|")[1]
-        st_ = context.user_data.get("stats_store", {}).get(uniq_id)
-        if not st_:
-            await query.edit_message_text("❗ Данные не найдены", parse_mode="HTML")
+        snap = await state.get_snapshot(uniq_id)
+        if not snap:
+            await show_expired(query)
             return
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✨ Рассчитать метрики", callback_data=f"metrics|{uniq_id}")],
-            [InlineKeyboardButton("Обновить", callback_data=f"update|{uniq_id}")],
-            [InlineKeyboardButton("Назад", callback_data="back_periods")]
-        ])
-        await query.edit_message_text(st_["base_text"], parse_mode="HTML", reply_markup=kb)
+        await query.edit_message_text(snap.base_text(), parse_mode="HTML", reply_markup=stats_keyboard(uniq_id))
         return
 
-    elif data.startswith("update|"):
+    elif data.startswith("days|") or data.startswith("top|"):
+        parts = data.split("|")
+        uniq_id = parts[1]
+        snap = await state.get_snapshot(uniq_id)
+        if not snap:
+            await show_expired(query)
+            return
+        scope = tuple(name for name in snap.tenants or () if name in tenants) or (default_tenant.name,)
+        if parts[0] == "days":
+            ok, result = await series_per_day(scope, snap.date_from, snap.date_to)
+            text = format_per_day(snap, result) if ok else f"❗ {result}"
+            kb = breakdown_keyboard(uniq_id)
+        else:
+            column, order = parts[2], parts[3]
+            if column not in SUB_ID_COLUMNS:
+                await query.edit_message_text("Неизвестная команда", parse_mode="HTML")
+                return
+            ok, result = await series_top(scope, snap.date_from, snap.date_to, column)
+            text = format_top(snap, result, column, order) if ok else f"❗ {result}"
+            kb = breakdown_keyboard(uniq_id, column, order)
+        await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
+        return
+
+    elif data.startswith("export|"):
         uniq_id = data.split("|")[1]
-        store = context.user_data.get("stats_store", {}).get(uniq_id)
-        if not store:
-            await query.edit_message_text("❗ Данные не найдены", parse_mode="HTML")
+        snap = await state.get_snapshot(uniq_id)
+        if not snap:
+            await show_expired(query)
             return
-        date_from = store.get("date_from")
-        date_to = store.get("date_to")
-        label = store.get("label")
-        if not (date_from and date_to and label):
-            await query.edit_message_text("❗ Ошибка параметров обновления", parse_mode="HTML")
+        scope = tuple(name for name in snap.tenants or () if name in tenants) or (default_tenant.name,)
+        # Прогресс — отдельным сообщением: экран статистики за время выгрузки
+        # могут сменить, и возвращать на него старый снимок нельзя
+        progress = await telegram_app.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=f"⏳ Готовлю CSV с конверсиями за {snap.date_from[:10]} .. {snap.date_to[:10]}…"
+        )
+        # Выгрузка может идти минуты — не держим webhook-запрос Telegram
+        task = asyncio.create_task(export_and_send(progress, snap, scope))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        return
+
+    elif data.startswith("update|"):
+        uniq_id = data.split("|")[1]
+        snap = await state.get_snapshot(uniq_id)
+        if not snap:
+            await show_expired(query)
             return
-        await show_stats_screen(query, context, date_from, date_to, label)
+        scope = tuple(name for name in snap.tenants or () if name in tenants) or (default_tenant.name,)
+        base = (snap.closed, snap.closed_until) if snap.closed is not None and snap.closed_until else None
+        await show_stats_screen(query, context, snap.date_from, snap.date_to, snap.label, scope, base=base)
         return
 
     await query.edit_message_text("Неизвестная команда", parse_mode="HTML")
@@ -435,53 +2970,547 @@ async def inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------------------
 # Показ статистики
 # ------------------------------
-async def show_stats_screen(query, context, date_from: str, date_to: str, label: str):
-    okc, cinfo = await get_common_data_aggregated(date_from, date_to)
+# Последние успешные итоги по периодам — для показа, пока Alanbase не отвечает
+last_good_stats = OrderedDict()
+_background_tasks = set()
+
+def remember_good_stats(scope: tuple, date_from: str, date_to: str, stats: dict):
+    key = (scope, date_from, date_to)
+    last_good_stats[key] = (time.time(), stats)
+    last_good_stats.move_to_end(key)
+    while len(last_good_stats) > 64:
+        last_good_stats.popitem(last=False)
+
+async def collect_stats(tenant, date_from: str, date_to: str):
+    """Параллельно запрашивает /common и /conversions аккаунта и объединяет итоги"""
+    local = STATS_SOURCE == "local" and ledger is not None
+    (okc, cinfo), (okr, rdata) = await asyncio.gather(
+        get_common_data_aggregated(tenant, date_from, date_to),
+        get_ledger_rfr(tenant, date_from, date_to) if local else get_rfr_aggregated(tenant, date_from, date_to)
+    )
+    if not okr and not local and ledger is not None:
+        logger.warning(f"{tenant.name}: /conversions недоступен ({rdata}), берём данные из журнала")
+        local = True
+        okr, rdata = await get_ledger_rfr(tenant, date_from, date_to)
+    if not okr:
+        return False, rdata
     if not okc:
-        text = f"❗ {cinfo}"
+        if not local:
+            return False, cinfo
+        # В локальном режиме журнал заменяет Alanbase: без /common нет только кликов
+        logger.warning(f"{tenant.name}: /common недоступен ({cinfo}), показываем данные журнала без кликов")
+        cinfo = {"click_count": 0, "click_unique": 0, "conf_count": 0, "conf_payout": rdata["revenue"], "common_missing": True}
+    return True, {**cinfo, **rdata, "rfr_source": "ledger" if local else "api"}
+
+_SUMMED_FIELDS = ("click_count", "click_unique", "registration", "ftd", "rdeposit", "conf_count", "conf_payout")
+
+async def collect_all_stats(group: list, date_from: str, date_to: str):
+    """Сводка по нескольким аккаунтам: запросы идут параллельно, упавшие аккаунты помечаются"""
+    results = await asyncio.gather(*(collect_stats(t, date_from, date_to) for t in group))
+    total = {field: 0 for field in _SUMMED_FIELDS}
+    sources, failed, errors = set(), [], []
+    for tenant, (ok, info) in zip(group, results):
+        if not ok:
+            logger.warning(f"Сводка: аккаунт {tenant.name} недоступен: {info}")
+            failed.append(tenant.name)
+            errors.append(f"{tenant.name}: {info}")
+            continue
+        for field in _SUMMED_FIELDS:
+            total[field] += info.get(field, 0)
+        sources.add(info["rfr_source"])
+        if info.get("common_missing"):
+            total["common_missing"] = True
+    if len(failed) == len(group):
+        return False, "; ".join(errors)
+    total["rfr_source"] = "ledger" if "ledger" in sources else "api"
+    total["failed_tenants"] = failed
+    return True, total
+
+async def _collect_scope_range(scope: tuple, date_from: str, date_to: str):
+    if len(scope) == 1:
+        return await collect_stats(tenants[scope[0]], date_from, date_to)
+    return await collect_all_stats([tenants[name] for name in scope], date_from, date_to)
+
+def _add_stats(a: dict, b: dict) -> dict:
+    out = {field: a.get(field, 0) + b.get(field, 0) for field in _SUMMED_FIELDS}
+    out["rfr_source"] = "ledger" if "ledger" in (a.get("rfr_source"), b.get("rfr_source")) else "api"
+    out["failed_tenants"] = list(dict.fromkeys((a.get("failed_tenants") or []) + (b.get("failed_tenants") or [])))
+    if a.get("common_missing") or b.get("common_missing"):
+        out["common_missing"] = True
+    return out
+
+async def collect_scope_stats(scope: tuple, date_from: str, date_to: str, base=None):
+    """Статистика выбранных аккаунтов; удачный результат запоминается для stale-while-revalidate.
+
+    Период делится на устоявшиеся дни (до settled_before) и меняющиеся. Итог устоявшихся
+    дней сохраняется в stats["closed"], и base=(closed, closed_until) из прошлого снимка
+    позволяет при обновлении докачать только дни начиная с closed_until.
+    """
+    start = datetime.strptime(date_from[:10], "%Y-%m-%d").date()
+    end = datetime.strptime(date_to[:10], "%Y-%m-%d").date()
+    if base is not None:
+        closed, known_until = base[0], datetime.strptime(base[1], "%Y-%m-%d").date()
+    else:
+        closed, known_until = {"rfr_source": "api"}, start
+    cutoff = min(settled_before(), end + timedelta(days=1))
+
+    def day_from(day):
+        return date_from if day == start else f"{day} 00:00"
+
+    def day_to(day):
+        return date_to if day == end else f"{day} 23:59"
+
+    parts = []
+    if known_until < cutoff:
+        parts.append((day_from(known_until), day_to(cutoff - timedelta(days=1))))
+    open_from = max(known_until, cutoff)
+    if open_from <= end:
+        parts.append((day_from(open_from), date_to))
+    results = await asyncio.gather(*(_collect_scope_range(scope, f, t) for f, t in parts))
+    for ok, info in results:
+        if not ok:
+            return False, info
+
+    if known_until < cutoff:
+        closed = _add_stats(closed, results[0][1])
+        results = results[1:]
+    stats = _add_stats(closed, results[0][1] if results else {})
+    # Итог с пропавшим аккаунтом или без кликов нельзя брать за основу — следующее обновление будет полным
+    partial = stats["failed_tenants"] or stats.get("common_missing")
+    if not partial:
+        stats["closed"] = {k: v for k, v in closed.items() if k != "failed_tenants"}
+        stats["closed_until"] = str(max(known_until, cutoff))
+    stats["tenants"] = list(scope)
+    if not stats.get("common_missing"):
+        remember_good_stats(scope, date_from, date_to, stats)
+    if base is not None:
+        logger.info(f"Дельта-обновление {date_from} - {date_to}: докачано с {known_until}")
+    return True, stats
+
+async def render_stats(query, label, date_from, date_to, fetched_at, stats, stale=False):
+    snap = StatsSnapshot(label, date_from, date_to, stats, fetched_at, stale)
+    uniq_id = await state.put_snapshot(snap)
+    await query.edit_message_text(snap.base_text(), parse_mode="HTML", reply_markup=stats_keyboard(uniq_id))
+
+async def _finish_refresh(query, fetch: asyncio.Task, label, date_from, date_to):
+    """Дожидается фонового запроса и заменяет устаревший экран свежими данными"""
+    try:
+        ok, stats = await fetch
+        if ok:
+            await render_stats(query, label, date_from, date_to, time.time(), stats)
+        else:
+            logger.warning(f"Фоновое обновление {date_from} - {date_to} не удалось: {stats}")
+    except asyncio.CancelledError:
+        # Экран заменён более новым запросом — свежие данные этого уже не нужны
+        fetch.cancel()
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка фонового обновления экрана: {e}")
+
+# Текущая задача экрана на сообщение: (chat_id, message_id) → Task
+_screen_tasks = {}
+# Задачи, отменённые более новым запросом к тому же сообщению (отличаем от прочих отмен)
+_superseded_screens = weakref.WeakSet()
+_stats_inflight = set()
+
+def _claim_screen(key, task: asyncio.Task):
+    """Делает task текущей для сообщения, отменяя предыдущую (вместе с её запросами к Alanbase)"""
+    previous = _screen_tasks.get(key)
+    if previous is not None and previous is not asyncio.current_task() and not previous.done():
+        previous.cancel()
+        _superseded_screens.add(previous)
+        STATS_REQUESTS.inc(result="superseded")
+    _screen_tasks[key] = task
+    task.add_done_callback(lambda t: _screen_tasks.pop(key, None) if _screen_tasks.get(key) is t else None)
+
+async def show_stats_screen(query, context, date_from: str, date_to: str, label: str, scope: tuple, prefetched=None, base=None):
+    """Один активный расчёт на сообщение: новый запрос отменяет ещё не закончившийся старый"""
+    key = (query.message.chat_id, query.message.message_id)
+    task = asyncio.create_task(
+        _show_stats_screen(query, key, date_from, date_to, label, scope, prefetched, base)
+    )
+    _claim_screen(key, task)
+    try:
+        await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            task.cancel()
+            raise
+        if task in _superseded_screens:
+            logger.debug(f"Экран {key} заменён более новым запросом")
+            return
+        # Отмена пришла не от нового запроса (например, изнутри общего запроса к Alanbase) —
+        # экран не должен остаться без ответа
+        logger.warning(f"Расчёт экрана {key} прерван")
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back_periods")]])
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
+        await query.edit_message_text(
+            "❗ Запрос статистики прерван — попробуйте ещё раз", parse_mode="HTML", reply_markup=kb
+        )
+
+async def _show_stats_screen(query, key, date_from: str, date_to: str, label: str, scope: tuple, prefetched, base):
+    if prefetched is not None:
+        await render_stats(query, label, date_from, date_to, *prefetched)
         return
-    cc = cinfo["click_count"]
-    uc = cinfo["click_unique"]
-    confc = cinfo["conf_count"]
-    confp = cinfo["conf_payout"]
 
-    okr, rdata = await get_rfr_aggregated(date_from, date_to)
-    if not okr:
-        text = f"❗ {rdata}"
+    stale = last_good_stats.get((scope, date_from, date_to))
+    if STATS_MAX_CONCURRENT and len(_stats_inflight) >= STATS_MAX_CONCURRENT:
+        # Alanbase не успевает — не ставим ещё один расчёт в очередь
+        STATS_REQUESTS.inc(result="shed")
+        logger.warning(f"Расчётов статистики уже {len(_stats_inflight)}, запрос {date_from} - {date_to} отклонён")
+        if stale is not None:
+            await render_stats(query, label, date_from, date_to, *stale, stale=True)
+            return
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back_periods")]])
+        await query.edit_message_text(
+            "⏳ Сейчас много запросов к Alanbase. Попробуйте через минуту.", parse_mode="HTML", reply_markup=kb
+        )
+        return
+
+    STATS_REQUESTS.inc(result="started")
+    fetch = asyncio.create_task(collect_scope_stats(scope, date_from, date_to, base))
+    _stats_inflight.add(fetch)
+    fetch.add_done_callback(_stats_inflight.discard)
+    try:
+        if stale is not None:
+            done, _ = await asyncio.wait({fetch}, timeout=ALANBASE_SWR_DEADLINE)
+            if not done:
+                # stale-while-revalidate: сразу показываем прошлые данные, свежие подставим позже
+                await render_stats(query, label, date_from, date_to, *stale, stale=True)
+                task = asyncio.create_task(_finish_refresh(query, fetch, label, date_from, date_to))
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+                # Фоновое обновление тоже правит это сообщение — новый запрос должен его отменить
+                _claim_screen(key, task)
+                return
+        ok, stats = await fetch
+    except asyncio.CancelledError:
+        fetch.cancel()
+        raise
+
+    if not ok:
+        if stale is not None:
+            await render_stats(query, label, date_from, date_to, *stale, stale=True)
+            return
+        text = f"❗ {stats}"
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back_periods")]])
         await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
         return
-    reg = rdata["registration"]
-    ftd = rdata["ftd"]
-    rd = rdata["rdeposit"]
-
-    date_lbl = f"{date_from[:10]} .. {date_to[:10]}"
-    base_text = build_stats_text(label, date_lbl, cc, uc, reg, ftd, rd, confc, confp)
-
-    if "stats_store" not in context.user_data:
-        context.user_data["stats_store"] = {}
-    uniq_id = str(uuid.uuid4())[:8]
-    context.user_data["stats_store"][uniq_id] = {
-        "base_text": base_text,
-        "clicks": cc,
-        "unique": uc,
-        "reg": reg,
-        "ftd": ftd,
-        "rd": rd,
-        "date_from": date_from,
-        "date_to": date_to,
-        "label": label,
-        "confp": confp
-    }
+    await render_stats(query, label, date_from, date_to, time.time(), stats)
 
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✨ Рассчитать метрики", callback_data=f"metrics|{uniq_id}")],
-        [InlineKeyboardButton("Обновить", callback_data=f"update|{uniq_id}")],
-        [InlineKeyboardButton("Назад", callback_data="back_periods")]
-    ])
-    await query.edit_message_text(base_text, parse_mode="HTML", reply_markup=kb)
+# ------------------------------
+# Выгрузка конверсий в CSV
+# ------------------------------
+def _flatten_row(row: dict, prefix: str = "") -> dict:
+    """{'goal': {'key': 'ftd'}} → {'goal.key': 'ftd'}; списки остаются JSON-строкой"""
+    out = {}
+    for key, value in row.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(_flatten_row(value, f"{name}."))
+        elif isinstance(value, list):
+            out[name] = json.dumps(value, ensure_ascii=False)
+        else:
+            out[name] = value
+    return out
+
+# Постоянные колонки выгрузки /conversions; поля вне этого списка не теряются,
+# а попадают JSON-объектом в колонку extra
+EXPORT_COLUMNS = (
+    "conversion_id", "datetime", "conversion_datetime", "status", "goal.key", "goal.name",
+    "payout", "currency", "offer.id", "offer.name", "click_id", "transaction_id",
+    *(f"sub_id{i}" for i in range(1, 11))
+)
+
+class CsvExport:
+    """CSV (опционально gzip) построчно в SpooledTemporaryFile; колонки постоянные (EXPORT_COLUMNS + extra)"""
+
+    def __init__(self, compress: bool, with_tenant: bool):
+        self.file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+        self._gzip = gzip.GzipFile(fileobj=self.file, mode="wb") if compress else None
+        self._text = io.TextIOWrapper(self._gzip or self.file, encoding="utf-8", newline="")
+        self._columns = (("tenant",) if with_tenant else ()) + EXPORT_COLUMNS
+        self._known = frozenset(self._columns)
+        self._writer = csv.writer(self._text)
+        self._writer.writerow((*self._columns, "extra"))
+        self.tenant = None
+        self.rows = 0
+
+    def add(self, row: dict):
+        flat = _flatten_row(row)
+        if "tenant" in self._known:
+            flat["tenant"] = self.tenant
+        # Заголовок не зависит от первой строки: null-объект в одной строке не прячет поле в других
+        extra = {k: v for k, v in flat.items() if k not in self._known and v is not None}
+        self._writer.writerow((
+            *(flat.get(name, "") for name in self._columns),
+            json.dumps(extra, ensure_ascii=False) if extra else ""
+        ))
+        self.rows += 1
+
+    def finish(self) -> int:
+        """Закрывает поток записи и возвращает размер файла; файл перемотан в начало"""
+        self._text.flush()
+        self._text.detach()
+        if self._gzip is not None:
+            self._gzip.close()
+        size = self.file.tell()
+        self.file.seek(0)
+        return size
+
+async def export_conversions(scope: tuple, date_from: str, date_to: str, compress: bool = EXPORT_GZIP):
+    """Страницы /conversions по очереди (память не растёт с размером периода) → (ok, CsvExport | ошибка)"""
+    export = CsvExport(compress, with_tenant=len(scope) > 1)
+    try:
+        for name in scope:
+            export.tenant = name
+            ok, info = await fetch_conversions(tenants[name], date_from, date_to, export.add, goal_keys=(), parallel=False)
+            if not ok:
+                export.file.close()
+                return False, info
+        return True, export
+    except Exception:
+        export.file.close()
+        raise
+
+async def export_and_send(progress, snap, scope: tuple):
+    """Готовит CSV и отправляет документом; progress — сообщение «Готовлю CSV…» в том же чате"""
+    chat_id = progress.chat_id
+    started = time.perf_counter()
+    try:
+        ok, export = await export_conversions(scope, snap.date_from, snap.date_to)
+        if not ok:
+            await progress.edit_text(f"❗ Ошибка выгрузки: {export}")
+            return
+        with export.file:
+            size = export.finish()
+            logger.info(
+                f"Выгрузка {snap.date_from} - {snap.date_to}: {export.rows} строк, {size} байт "
+                f"за {time.perf_counter() - started:.1f} с"
+            )
+            if size > EXPORT_MAX_BYTES:
+                await progress.edit_text(
+                    f"❗ Файл {size // (1024 * 1024)} МБ больше лимита Telegram — выберите период короче"
+                )
+                return
+            suffix = ".csv.gz" if EXPORT_GZIP else ".csv"
+            filename = f"conversions_{snap.date_from[:10]}_{snap.date_to[:10]}{suffix}"
+            # PTB всё равно читает файл целиком при отправке, а у SpooledTemporaryFile нет имени
+            await telegram_app.bot.send_document(
+                chat_id=chat_id, document=export.file.read(), filename=filename,
+                caption=f"📥 Конверсии за {snap.date_from[:10]} .. {snap.date_to[:10]}: {export.rows} строк"
+            )
+        try:
+            await progress.delete()
+        except Exception as e:
+            logger.warning(f"Не удалось удалить сообщение о выгрузке: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки CSV: {e}")
+        await telegram_app.bot.send_message(chat_id=chat_id, text=f"❗ Ошибка выгрузки: {e}")
+
+# ------------------------------
+# Live-дашборд за сегодня
+# ------------------------------
+class LiveDashboard:
+    """Счётчики аккаунта за текущий день МСК в закреплённом сообщении"""
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.chat_id = tenant.notify_chat_id
+        self.day = today_msk()
+        self.stats = self._empty()
+        self.reconciled_at = None
+        self.updated_at = time.time()
+        self._message_id = None
+        self._last_edit = 0.0
+        self._edit_task = None
+        self._reconcile_task = None
+
+    @staticmethod
+    def _empty() -> dict:
+        return {
+            "click_count": 0, "click_unique": 0, "registration": 0, "ftd": 0, "rdeposit": 0,
+            "conf_count": 0, "conf_payout": 0.0, "rfr_source": "api"
+        }
+
+    def _roll_day(self):
+        day = today_msk()
+        if day != self.day:
+            self.day = day
+            self.stats = self._empty()
+            self.reconciled_at = None
+
+    def record(self, data: dict):
+        """Учитывает принятый postback (только конверсии сегодняшнего дня)"""
+        self._roll_day()
+        if parse_conversion_date(data.get("conversion_date"))[:10] != str(self.day):
+            return
+        goal = data.get("goal")
+        if goal in self.stats:
+            self.stats[goal] += 1
+        if str(data.get("status", "")).lower() == "confirmed":
+            self.stats["conf_count"] += 1
+            self.stats["conf_payout"] += _parse_revenue(data.get("revenue"))
+        self.updated_at = time.time()
+        self.schedule_edit()
+
+    def snapshot(self):
+        """(fetched_at, stats) для экрана «Сегодня» или None, если сверки не было или она давно не удавалась.
+
+        Клики меняются только при сверке, поэтому временем данных считается она,
+        а время последнего postback'а идёт отдельно в live_at.
+        """
+        self._roll_day()
+        if self.reconciled_at is None or time.time() - self.reconciled_at > 2 * DASHBOARD_RECONCILE_INTERVAL:
+            return None
+        return self.reconciled_at, {**self.stats, "tenants": [self.tenant.name], "live_at": self.updated_at}
+
+    async def reconcile(self):
+        day = today_msk()
+        ok, stats = await collect_stats(self.tenant, f"{day} 00:00", f"{day} 23:59")
+        if ok and stats.get("common_missing"):
+            ok, stats = False, "нет данных /common"
+        if not ok:
+            logger.warning(f"Сверка дашборда {self.tenant.name} не удалась: {stats}")
+            return
+        self._roll_day()
+        drift = {k: stats[k] - self.stats[k] for k in ("registration", "ftd", "rdeposit") if stats[k] != self.stats[k]}
+        if drift and self.reconciled_at is not None:
+            logger.info(f"Дашборд {self.tenant.name}: поправка по /common {drift}")
+        self.stats = {**self._empty(), **stats}
+        self.reconciled_at = self.updated_at = time.time()
+        self.schedule_edit()
+
+    async def _reconcile_loop(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Ошибка сверки дашборда {self.tenant.name}: {e}")
+            await asyncio.sleep(DASHBOARD_RECONCILE_INTERVAL)
+
+    def text(self) -> str:
+        s = self.stats
+        text = build_stats_text(
+            "Сегодня, live", str(self.day), s["click_count"], s["click_unique"], s["registration"],
+            s["ftd"], s["rdeposit"], s["conf_count"], s["conf_payout"]
+        )
+        updated = datetime.fromtimestamp(self.updated_at, MSK_TZ).strftime("%H:%M:%S")
+        text += f"\n🔴 <i>Обновлено в {updated} МСК</i>"
+        if self.reconciled_at is not None:
+            checked = datetime.fromtimestamp(self.reconciled_at, MSK_TZ).strftime("%H:%M")
+            text += f"\n🔁 <i>Сверено с Alanbase в {checked} МСК</i>"
+        return text
+
+    def schedule_edit(self):
+        if self._edit_task is None:
+            self._edit_task = asyncio.create_task(self._edit_later())
+
+    async def _edit_later(self):
+        loop = asyncio.get_running_loop()
+        delay = self._last_edit + DASHBOARD_EDIT_INTERVAL - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Изменения после этой точки запланируют следующую правку
+        self._edit_task = None
+        self._last_edit = loop.time()
+        try:
+            await self._publish()
+        except RetryAfter as e:
+            self._last_edit = loop.time() + _retry_after_seconds(e)
+            self.schedule_edit()
+        except Exception as e:
+            logger.error(f"Не удалось обновить дашборд {self.tenant.name}: {e}")
+
+    async def _publish(self):
+        state_key = f"dashboard:{self.tenant.name}"
+        if self._message_id is None:
+            self._message_id = await state.get_value(state_key, "message_id")
+        await chat_limiter.wait(self.chat_id)
+        if self._message_id is not None:
+            try:
+                await telegram_app.bot.edit_message_text(
+                    chat_id=self.chat_id, message_id=self._message_id, text=self.text(), parse_mode="HTML"
+                )
+                return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                logger.warning(f"Дашборд {self.tenant.name} не найден ({e}), отправляем заново")
+        message = await telegram_app.bot.send_message(chat_id=self.chat_id, text=self.text(), parse_mode="HTML")
+        self._message_id = message.message_id
+        await state.set_value(state_key, "message_id", self._message_id)
+        try:
+            await telegram_app.bot.pin_chat_message(
+                chat_id=self.chat_id, message_id=self._message_id, disable_notification=True
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось закрепить дашборд {self.tenant.name}: {e}")
+
+    def start(self):
+        if self._reconcile_task is None:
+            self._reconcile_task = asyncio.create_task(self._reconcile_loop())
+
+    async def stop(self):
+        tasks = [t for t in (self._reconcile_task, self._edit_task) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._reconcile_task = self._edit_task = None
+
+dashboards = {}
+_dashboard_lock = None
+
+if importlib.util.find_spec("fcntl") is not None:
+    import fcntl
+else:
+    fcntl = None
+
+def _dashboard_single_worker() -> bool:
+    """Проверяет, что дашборд ведёт один процесс, и берёт блокировку на время его работы"""
+    global _dashboard_lock
+    if STATE_BACKEND != "memory" or int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+        logger.error("Live-дашборд работает только с одним воркером (STATE_BACKEND=memory, WEB_CONCURRENCY=1)")
+        return False
+    if not DASHBOARD_LOCK_PATH or fcntl is None:
+        return True
+    fh = open(DASHBOARD_LOCK_PATH, "a")
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        logger.error(f"Live-дашборд уже ведёт другой процесс ({DASHBOARD_LOCK_PATH}); запущено несколько воркеров?")
+        return False
+    _dashboard_lock = fh
+    return True
+
+def start_dashboards():
+    if not DASHBOARD_ENABLED or dashboards:
+        return
+    if _dashboard_lock is None and not _dashboard_single_worker():
+        return
+    for tenant in tenants.values():
+        if tenant.notify_chat_id is not None and tenant.name not in dashboards:
+            dashboards[tenant.name] = LiveDashboard(tenant)
+            dashboards[tenant.name].start()
+    logger.info(f"Live-дашборды: {', '.join(dashboards) or 'нет чатов'}")
+
+async def stop_dashboards():
+    global _dashboard_lock
+    for dashboard in dashboards.values():
+        await dashboard.stop()
+    dashboards.clear()
+    if _dashboard_lock is not None:
+        _dashboard_lock.close()
+        _dashboard_lock = None
+
+def live_today(scope: tuple, date_from: str, date_to: str):
+    """Экран «Сегодня» из счётчиков дашборда — без запросов к Alanbase"""
+    if len(scope) != 1 or scope[0] not in dashboards:
+        return None
+    dashboard = dashboards[scope[0]]
+    if (date_from[:10], date_to[:10]) != (str(dashboard.day), str(dashboard.day)):
+        return None
+    return dashboard.snapshot()
 
 # ------------------------------
 # Хэндлер ввода дат (Свой период)
@@ -492,7 +3521,8 @@ async def period_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not await check_access(update):
         return
     
-    if not context.user_data.get("awaiting_period"):
+    user_id = update.effective_user.id
+    if not await state.get_value(user_id, "awaiting_period"):
         return
     
     try:
@@ -504,31 +3534,25 @@ async def period_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     logger.info(f"Ввод периода: {txt}")
     
     if txt.lower() == "назад":
-        context.user_data["awaiting_period"] = False
-        inline_id = context.user_data.get("inline_msg_id")
+        await state.set_value(user_id, "awaiting_period", False)
+        inline_id = await state.get_value(user_id, "inline_msg_id")
         if inline_id:
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Сегодня", callback_data="period_today"),
-                 InlineKeyboardButton("7 дней", callback_data="period_7days"),
-                 InlineKeyboardButton("За месяц", callback_data="period_month")],
-                [InlineKeyboardButton("Свой период", callback_data="period_custom")],
-                [InlineKeyboardButton("Назад", callback_data="back_menu")]
-            ])
+            text, kb = await period_menu(user_id, update.effective_chat.id)
             await telegram_app.bot.edit_message_text(
                 chat_id=update.effective_chat.id,
                 message_id=inline_id,
-                text="Выберите период:",
+                text=text,
                 parse_mode="HTML",
                 reply_markup=kb
             )
-        context.user_data.pop("inline_msg_id", None)
-        context.user_data["awaiting_period"] = False
+        await state.pop_value(user_id, "inline_msg_id")
+        await state.set_value(user_id, "awaiting_period", False)
         return
     
     parts = txt.split(",")
     if len(parts) != 2:
         await update.message.reply_text("❗ Формат: YYYY-MM-DD,YYYY-MM-DD или 'Назад'")
-        context.user_data["awaiting_period"] = False
+        await state.set_value(user_id, "awaiting_period", False)
         return
     
     try:
@@ -536,17 +3560,17 @@ async def period_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         ed_d = datetime.strptime(parts[1].strip(), "%Y-%m-%d").date()
     except:
         await update.message.reply_text("❗ Ошибка разбора дат.")
-        context.user_data["awaiting_period"] = False
+        await state.set_value(user_id, "awaiting_period", False)
         return
     
     if st_d > ed_d:
         await update.message.reply_text("❗ Начальная дата больше конечной.")
-        context.user_data["awaiting_period"] = False
+        await state.set_value(user_id, "awaiting_period", False)
         return
     
     # Корректный ввод: обновляем статистику
-    context.user_data["awaiting_period"] = False
-    inline_id = context.user_data.pop("inline_msg_id", None)
+    await state.set_value(user_id, "awaiting_period", False)
+    inline_id = await state.pop_value(user_id, "inline_msg_id")
     
     # Убедимся, что inline_id существует
     if not inline_id:
@@ -559,12 +3583,13 @@ async def period_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Используем chat_id из текущего сообщения для редактирования
     chat_id = update.effective_chat.id
+    scope = await current_scope(user_id, chat_id)
     try:
-        await show_stats_screen(update.callback_query, context, date_from, date_to, lbl)
+        await show_stats_screen(update.callback_query, context, date_from, date_to, lbl, scope)
     except AttributeError:
         # Если это не callback_query, создаем FakeQ с chat_id и inline_id
         fquery = FakeQ(inline_id, chat_id)
-        await show_stats_screen(fquery, context, date_from, date_to, lbl)
+        await show_stats_screen(fquery, context, date_from, date_to, lbl, scope)
 
 
 # ------------------------------
@@ -590,14 +3615,8 @@ async def reply_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         link = "Ваш личный кабинет: https://cabinet.4rabetpartner.com/statistics"
         await update.message.reply_text(link, parse_mode="HTML", reply_markup=get_main_menu())
     elif text == "📊 Получить статистику":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Сегодня", callback_data="period_today"),
-             InlineKeyboardButton("7 дней", callback_data="period_7days"),
-             InlineKeyboardButton("За месяц", callback_data="period_month")],
-            [InlineKeyboardButton("Свой период", callback_data="period_custom")],
-            [InlineKeyboardButton("Назад", callback_data="back_menu")]
-        ])
-        await update.message.reply_text("Выберите период:", parse_mode="HTML", reply_markup=kb)
+        text, kb = await period_menu(update.effective_user.id, update.effective_chat.id)
+        await update.message.reply_text(text, parse_mode="HTML", reply_markup=kb)
     elif text == "⬅️ Назад":
         mk = get_main_menu()
         await update.message.reply_text("Главное меню:", parse_mode="HTML", reply_markup=mk)
@@ -627,6 +3646,7 @@ class FakeQ:
 # Регистрация хэндлеров
 # ------------------------------
 telegram_app.add_handler(CommandHandler("start", start_command))
+telegram_app.add_handler(CommandHandler("profile", profile_command))
 telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, period_text_handler), group=1)
 telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, reply_button_handler), group=2)
 telegram_app.add_handler(CallbackQueryHandler(inline_handler))
@@ -636,6 +3656,4 @@ telegram_app.add_handler(CallbackQueryHandler(inline_handler))
 # ------------------------------
 if __name__ == "__main__":
     import uvicorn
-    loop = asyncio.get_event_loop()
-    loop.create_task(init_telegram_app())
     uvicorn.run(app, host="0.0.0.0", port=PORT)
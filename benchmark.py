@@ -0,0 +1,400 @@
+"""
+Офлайн-бенчмарк PostApi.
+
+Поднимает локальные заглушки Alanbase (/partner/statistic/common и
+постраничный /partner/statistic/conversions) и Telegram Bot API, запускает
+app.py под uvicorn и нагружает /webhook потоком postback'ов и нажатиями
+inline-кнопок. Сеть не нужна.
+
+Заглушки, сервис и генератор нагрузки работают в отдельных процессах, чтобы
+задержки отражали сам сервис, а не борьбу за один event loop.
+
+Пример:
+    python benchmark.py --postbacks 5000 --concurrency 100 --callbacks 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+
+BENCH_CHAT_ID = 100500
+BENCH_TOKEN = "123456:BENCH"
+GOALS = ("registration", "ftd", "rdeposit")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+# ------------------------------
+# Заглушка Alanbase
+# ------------------------------
+def build_alanbase_mock(args, counters: dict) -> FastAPI:
+    mock = FastAPI()
+
+    def days_in(params) -> list:
+        start = datetime.strptime(params["date_from"][:10], "%Y-%m-%d").date()
+        end = datetime.strptime(params["date_to"][:10], "%Y-%m-%d").date()
+        return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    @mock.get("/partner/statistic/common")
+    async def common(request: Request):
+        counters["common"] += 1
+        await asyncio.sleep(args.alanbase_latency)
+        rows = [
+            {
+                "day": str(day),
+                "click_count": args.rows_per_day * 20,
+                "click_unique_count": args.rows_per_day * 15,
+                "conversions": {"confirmed": {"count": args.rows_per_day // 3, "payout": args.rows_per_day * 7.5}}
+            }
+            for day in days_in(request.query_params)
+        ]
+        return {"data": rows}
+
+    @mock.get("/partner/statistic/conversions")
+    async def conversions(request: Request):
+        counters["conversions"] += 1
+        await asyncio.sleep(args.alanbase_latency)
+        params = request.query_params
+        days = days_in(params)
+        per_page = int(params.get("per_page", 500))
+        page = int(params.get("page", 1))
+        total = args.rows_per_day * len(days)
+        first = (page - 1) * per_page
+        rows = []
+        for i in range(first, min(first + per_page, total)):
+            day = days[i // args.rows_per_day]
+            rows.append({
+                "conversion_id": i,
+                "datetime": f"{day} {i % 24:02d}:00:00",
+                "goal": {"key": GOALS[i % 3], "name": GOALS[i % 3]},
+                "status": "confirmed",
+                "payout": 7.5,
+                "sub_id3": f"approach{i % 4}",
+                "sub_id4": f"campaign{i % 17}",
+                "sub_id5": f"adset{i % 41}"
+            })
+        last_page = max(1, -(-total // per_page))
+        return {
+            "data": rows,
+            "meta": {"page": page, "per_page": per_page, "total_count": total, "last_page": last_page}
+        }
+
+    @mock.get("/bench/counters")
+    async def bench_counters():
+        return counters
+
+    return mock
+
+
+# ------------------------------
+# Заглушка Telegram Bot API
+# ------------------------------
+def build_telegram_mock(args, counters: dict) -> FastAPI:
+    mock = FastAPI()
+    chat = {"id": BENCH_CHAT_ID, "type": "private", "first_name": "Bench"}
+
+    @mock.post("/bot{token}/{method}")
+    async def bot_method(token: str, method: str, request: Request):
+        counters[method] = counters.get(method, 0) + 1
+        await asyncio.sleep(args.telegram_latency)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = {"message_id": random.randint(1, 10 ** 6), "date": int(time.time()), "chat": chat, "text": ""}
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    @mock.get("/bench/counters")
+    async def bench_counters():
+        return counters
+
+    return mock
+
+
+# ------------------------------
+# Нагрузка
+# ------------------------------
+def make_postback(i: int) -> dict:
+    return {
+        "click_id": f"bench-{i}",
+        "offer_id": str(100 + i % 5),
+        "goal": GOALS[i % 3],
+        "revenue": "7.50",
+        "currency": "USD",
+        "status": "confirmed",
+        "sub_id3": f"approach{i % 4}",
+        "sub_id4": f"campaign{i % 17}",
+        "sub_id5": f"adset{i % 41}",
+        "conversion_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+def make_callback_update(i: int, data: str) -> dict:
+    user = {"id": BENCH_CHAT_ID, "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": 10 ** 6 + i,
+        "callback_query": {
+            "id": f"cb{i}",
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": 1000 + i,
+                "date": int(time.time()),
+                "chat": {"id": BENCH_CHAT_ID, "type": "private", "first_name": "Bench"},
+                "text": "Выберите период:"
+            }
+        }
+    }
+
+
+async def drive(client: httpx.AsyncClient, total: int, concurrency: int, make_request) -> dict:
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                resp = await make_request(i)
+                if resp.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": total,
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": total / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0
+    }
+
+
+def print_report(name: str, res: dict):
+    print(
+        f"{name:<22} {res['requests']:>7} req  {res['rps']:>9.1f} req/s  "
+        f"p50 {res['p50_ms']:>8.2f} ms  p95 {res['p95_ms']:>8.2f} ms  "
+        f"p99 {res['p99_ms']:>8.2f} ms  errors {res['errors']}"
+    )
+
+
+def serve_stub(args):
+    """Режим дочернего процесса: одна заглушка на своём порту"""
+    if args.serve == "alanbase":
+        mock = build_alanbase_mock(args, {"common": 0, "conversions": 0})
+    else:
+        mock = build_telegram_mock(args, {})
+    uvicorn.run(mock, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def spawn_stub(kind: str, port: int) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--serve", kind, "--port", str(port)])
+
+
+def spawn_app(port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, **env}
+    )
+
+
+async def wait_listening(url: str, procs: list, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=1) as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                pass
+            for proc in procs:
+                if proc.poll() is not None:
+                    raise SystemExit(f"Процесс {proc.args} завершился с кодом {proc.returncode}")
+            if time.monotonic() > deadline:
+                raise SystemExit(f"{url} не ответил за {timeout:.0f} с")
+            await asyncio.sleep(0.05)
+
+
+def stop_processes(procs: list):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+async def main(args):
+    alanbase_port, telegram_port, app_port = free_port(), free_port(), free_port()
+    workdir = tempfile.mkdtemp(prefix="postapi-bench-")
+    alanbase_url = f"http://127.0.0.1:{alanbase_port}"
+    telegram_url = f"http://127.0.0.1:{telegram_port}"
+
+    env = {
+        "PP_API_KEY": "bench",
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_CHAT_ID": str(BENCH_CHAT_ID),
+        "BASE_API_URL": alanbase_url,
+        "TELEGRAM_API_URL": telegram_url,
+        "TELEGRAM_CHAT_MIN_INTERVAL": str(args.chat_interval),
+        "STATS_CACHE_PATH": "" if args.no_cache else os.path.join(workdir, "stats_cache.sqlite3"),
+        "LEDGER_PATH": os.path.join(workdir, "ledger.sqlite3"),
+        "LOG_LEVEL": "WARNING",
+        "ADMIN_TOKEN": "bench"
+    }
+    if not args.prewarm:
+        # Иначе нажатия отвечаются прогретыми снимками и живой путь статистики не меряется
+        env.update({"STARTUP_PREFETCH": "0", "PREWARM_INTERVAL": "0"})
+
+    procs = [spawn_stub("alanbase", alanbase_port), spawn_stub("telegram", telegram_port)]
+    try:
+        await wait_listening(f"{alanbase_url}/bench/counters", procs)
+        await wait_listening(f"{telegram_url}/bench/counters", procs)
+        procs.append(spawn_app(app_port, env))
+        await wait_listening(f"http://127.0.0.1:{app_port}/ready", procs)
+        await run_load(args, f"http://127.0.0.1:{app_port}", alanbase_url, telegram_url)
+    finally:
+        # Сервис первым: при остановке он ещё досылает очередь в заглушку Telegram
+        stop_processes(procs[2:])
+        stop_processes(procs[:2])
+
+
+async def run_load(args, base: str, alanbase_url: str, telegram_url: str):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {}
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=120) as client:
+        while (await client.get("/ready")).status_code != 200:
+            await asyncio.sleep(0.05)
+
+        if args.postbacks:
+            results["postback_get"] = await drive(
+                client, args.postbacks, args.concurrency,
+                lambda i: client.get("/webhook", params=make_postback(i))
+            )
+            print_report("postback GET /webhook", results["postback_get"])
+
+            offset = args.postbacks
+            results["postback_post"] = await drive(
+                client, args.postbacks, args.concurrency,
+                lambda i: client.post("/webhook", json=make_postback(offset + i))
+            )
+            print_report("postback POST /webhook", results["postback_post"])
+
+            drain_started = time.perf_counter()
+            while (await client.get("/postback/stats")).json()["queue_depth"]:
+                await asyncio.sleep(0.01)
+            results["queue_drain_seconds"] = time.perf_counter() - drain_started
+            print(f"{'очередь доставки':<22} опустела за {results['queue_drain_seconds']:.2f} с")
+
+        if args.bulk_batches:
+            offset = 2 * args.postbacks
+            results["postback_bulk"] = await drive(
+                client, args.bulk_batches, min(args.concurrency, args.bulk_batches),
+                lambda i: client.post(
+                    "/postback",
+                    content="\n".join(
+                        json.dumps(make_postback(offset + i * args.bulk_size + j)) for j in range(args.bulk_size)
+                    ),
+                    headers={"Content-Type": "application/x-ndjson"}
+                )
+            )
+            res = results["postback_bulk"]
+            print_report(f"bulk /postback x{args.bulk_size}", res)
+            print(f"{'  конверсий в секунду':<22} {res['rps'] * args.bulk_size:.0f}")
+
+        if args.profile:
+            await client.post("/admin/profile", params={"updates": args.profile}, headers={"X-Admin-Token": "bench"})
+
+        for period in args.periods:
+            results[f"callback_{period}"] = await drive(
+                client, args.callbacks, args.callback_concurrency,
+                lambda i: client.post("/webhook", json=make_callback_update(i, period))
+            )
+            print_report(f"callback {period}", results[f"callback_{period}"])
+
+        if args.profile:
+            summary = (await client.get("/admin/profile", headers={"X-Admin-Token": "bench"})).json()
+            results["profile"] = summary
+            print(f"Профиль ({summary['updates']} обновлений), фазы:")
+            for name, ph in summary["phases"].items():
+                print(f"  {name:<10} {ph['count']:>5}  сумма {ph['total']:.3f} с  среднее {ph['avg'] * 1000:.2f} мс")
+
+        counters = (await client.get(f"{alanbase_url}/bench/counters")).json()
+        tg_counters = (await client.get(f"{telegram_url}/bench/counters")).json()
+    results["alanbase_requests"] = counters
+    results["telegram_requests"] = tg_counters
+    print(f"Запросов к Alanbase: {counters}")
+    print(f"Запросов к Telegram: {tg_counters}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, ensure_ascii=False, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк PostApi")
+    parser.add_argument("--postbacks", type=int, default=2000, help="postback'ов на каждый метод (GET/POST)")
+    parser.add_argument("--concurrency", type=int, default=50, help="параллельных клиентов для postback'ов")
+    parser.add_argument("--bulk-batches", type=int, default=0, help="пакетных запросов на /postback (NDJSON)")
+    parser.add_argument("--bulk-size", type=int, default=1000, help="конверсий в одном пакете")
+    parser.add_argument("--callbacks", type=int, default=50, help="нажатий на каждый период")
+    parser.add_argument("--callback-concurrency", type=int, default=5)
+    parser.add_argument("--periods", nargs="+", default=["period_today", "period_7days", "period_month"])
+    parser.add_argument("--alanbase-latency", type=float, default=0.05, help="задержка ответа Alanbase, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.01, help="задержка ответа Telegram, с")
+    parser.add_argument("--rows-per-day", type=int, default=300, help="строк /conversions на день")
+    parser.add_argument("--chat-interval", type=float, default=0.0, help="TELEGRAM_CHAT_MIN_INTERVAL для бота")
+    parser.add_argument("--profile", type=int, default=0, help="профилировать первые N нажатий (/admin/profile)")
+    parser.add_argument("--no-cache", action="store_true", help="выключить дневной кэш")
+    parser.add_argument("--prewarm", action="store_true", help="включить прогрев периодов (нажатия попадут в снимки)")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    # Служебные: так бенчмарк запускает заглушки в дочерних процессах
+    parser.add_argument("--serve", choices=("alanbase", "telegram"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.serve:
+        serve_stub(args)
+    else:
+        asyncio.run(main(args))